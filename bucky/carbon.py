@@ -97,6 +97,16 @@ class PlaintextClient(CarbonClient):
     def send(self, host, name, value, mtime, metadata=None):
         stat = names.statname(host, name)
         mesg = "%s %s %s\n" % (stat, value, mtime)
+        self.transmit(mesg)
+
+    def send_frame(self, frame):
+        lines = []
+        for sample in frame:
+            stat = names.statname(sample[0], sample[1])
+            lines.append("%s %s %s\n" % (stat, sample[2], sample[3]))
+        self.transmit("".join(lines))
+
+    def transmit(self, mesg):
         for i in xrange(self.max_reconnects):
             try:
                 self.sock.sendall(mesg)
@@ -6,7 +6,10 @@ uid = None
 gid = None
 directory = "/var/lib/bucky"
 process_join_timeout = 2
+supervise_interval = 1
 max_sample_queue = 0
+udp_recv_batch = 64
+udp_drops_interval = 60
 
 sentry_enabled = False
 sentry_dsn = None
@@ -16,17 +19,42 @@ sentry_auto_log_stacks = False
 metricsd_ip = "127.0.0.1"
 metricsd_port = 23632
 metricsd_enabled = True
+metricsd_recv_buffer = 0
 metricsd_default_interval = 10.0
 metricsd_handlers = []
+metricsd_handler_shards = 1
+metricsd_route_cache_size = 10000
 
 collectd_ip = "127.0.0.1"
 collectd_port = 25826
 collectd_enabled = True
+collectd_recv_buffer = 0
 collectd_types = []
+collectd_types_cache = None
 collectd_converters = []
 collectd_use_entry_points = True
+collectd_filter_allow = []
+collectd_filter_deny = []
 collectd_counter_eq_derive = False
 collectd_workers = 1
+collectd_reuseport = False
+collectd_restart_workers = True
+collectd_balance_interval = 60
+collectd_balance_threshold = 0
+collectd_persistent_samples = False
+collectd_samples_savefile = "collectd_samples.save"
+collectd_samples_save_interval = 60
+collectd_samples_max_age = 600
+collectd_samples_ttl = 1800
+collectd_forward_ip = None
+collectd_forward_port = 25826
+collectd_forward_mtu = 1452
+collectd_forward_interval = 1
+collectd_forward_username = None
+collectd_forward_password = None
+collectd_name_cache_size = 10000
+collectd_rollup_window = 0
+collectd_rollup_function = "avg"
 
 collectd_security_level = 0
 collectd_auth_file = None
@@ -34,6 +62,8 @@ collectd_auth_file = None
 statsd_ip = "127.0.0.1"
 statsd_port = 8125
 statsd_enabled = True
+statsd_workers = 1
+statsd_recv_buffer = 0
 statsd_flush_time = 10.0
 statsd_metadata = {}
 statsd_legacy_namespace = True
@@ -44,6 +74,12 @@ statsd_prefix_set = "sets"
 statsd_prefix_gauge = "gauges"
 statsd_persistent_gauges = False
 statsd_gauges_savefile = "gauges.save"
+# the following settings are only relevant if `statsd_persistent_gauges` is `True`
+statsd_gauges_journal = False
+statsd_gauges_journal_compact_interval = 300
+statsd_flush_frames = False
+statsd_frame_size = 0
+statsd_key_cache_size = 10000
 statsd_delete_idlestats = False
 # the following settings are only relevant if `statsd_delete_idlestats` is `True`
 statsd_delete_counters = True
@@ -67,6 +103,13 @@ statsd_timer_sum_squares = True
 statsd_timer_median = True
 statsd_timer_std = True
 
+statsd_timer_sketch = False
+statsd_timer_sketch_accuracy = 0.01
+statsd_timer_sketch_max_bins = 2048
+statsd_timer_numpy = False
+statsd_set_hyperloglog = False
+statsd_set_hyperloglog_precision = 14
+
 graphite_enabled = True
 graphite_ip = "127.0.0.1"
 graphite_port = 2003
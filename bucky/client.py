@@ -17,6 +17,8 @@
 import multiprocessing
 import logging
 
+from bucky.frames import SampleFrame
+
 try:
     from setproctitle import setproctitle
 except ImportError:
@@ -42,7 +44,14 @@ class Client(multiprocessing.Process):
                 continue
             if sample is None:
                 break
-            self.send(*sample)
+            if isinstance(sample, SampleFrame):
+                self.send_frame(sample)
+            else:
+                self.send(*sample)
 
     def send(self, host, name, value, time, metadata=None):
         raise NotImplementedError()
+
+    def send_frame(self, frame):
+        for sample in frame:
+            self.send(*sample)
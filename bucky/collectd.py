@@ -13,11 +13,18 @@
 # the License.
 
 import os
+import re
 import six
-import copy
+import sys
+import glob
+import fnmatch
+import marshal
 import struct
+import time
 import signal
+import socket
 import logging
+import threading
 import multiprocessing
 
 import hmac
@@ -25,6 +32,15 @@ from hashlib import sha1
 from hashlib import sha256
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from cryptography.hazmat.backends import default_backend
+try:
+    from cryptography.hazmat.decrepit.ciphers.modes import OFB
+except ImportError:
+    OFB = modes.OFB
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 try:
     from setproctitle import setproctitle
@@ -34,7 +50,7 @@ except ImportError:
 
 from bucky.errors import ConfigError, ProtocolError
 from bucky.udpserver import UDPServer
-from bucky.helpers import FileMonitor
+from bucky.helpers import FileMonitor, LRUCache, jump_hash, stable_hash
 
 log = logging.getLogger(__name__)
 
@@ -94,10 +110,52 @@ DEFAULT_CONVERTERS = {
 }
 
 
+class CollectDSample(Mapping):
+    """
+    A single value parsed from a collectd packet. Behaves like a read only
+    dict, the header fields (host, plugin, type, ...) are shared between
+    all samples parsed from the same header parts.
+    """
+
+    __slots__ = ("header", "value_name", "value_type", "value")
+
+    VALUE_FIELDS = ("value_name", "value_type", "value")
+
+    def __init__(self, header, value_name, value_type, value):
+        self.header = header
+        self.value_name = value_name
+        self.value_type = value_type
+        self.value = value
+
+    def __getitem__(self, key):
+        if key in self.VALUE_FIELDS:
+            return getattr(self, key)
+        return self.header[key]
+
+    def __iter__(self):
+        for key in self.header:
+            yield key
+        for key in self.VALUE_FIELDS:
+            yield key
+
+    def __len__(self):
+        return len(self.header) + len(self.VALUE_FIELDS)
+
+    def __repr__(self):
+        return "CollectDSample(%r)" % dict(self)
+
+
 class CollectDTypes(object):
-    def __init__(self, types_dbs=[]):
+    # Gauges are sent in little endian, all other value types in network order
+    value_formats = {0: ("!", "Q"), 1: ("<", "d"), 2: ("!", "q"), 3: ("!", "Q")}
+    # Bumped whenever the layout of the compiled cache changes
+    CACHE_VERSION = 1
+
+    def __init__(self, types_dbs=[], cache_file=None):
         self.types = {}
         self.type_ranges = {}
+        self.type_signatures = {}
+        self.value_structs = {}
         if not types_dbs:
             types_dbs = filter(os.path.exists, [
                 "/usr/share/collectd/types.db",
@@ -105,7 +163,9 @@ class CollectDTypes(object):
             ])
             if not types_dbs:
                 raise ConfigError("Unable to locate types.db")
-        self.types_dbs = types_dbs
+        # Read twice with the cache, for its key and to parse the files
+        self.types_dbs = list(types_dbs)
+        self.cache_file = cache_file
         self._load_types()
 
     def get(self, name):
@@ -115,6 +175,10 @@ class CollectDTypes(object):
         return t
 
     def _load_types(self):
+        if self.cache_file:
+            cache_key = self._cache_key()
+            if self._load_cache(cache_key):
+                return
         for types_db in self.types_dbs:
             with open(types_db) as handle:
                 for line in handle:
@@ -124,6 +188,56 @@ class CollectDTypes(object):
                         continue
                     self._add_type_line(line)
             log.info("Loaded collectd types from %s", types_db)
+        if self.cache_file:
+            self._save_cache(cache_key)
+
+    def _cache_key(self):
+        # marshal's format may change between Python versions
+        key = [self.CACHE_VERSION, tuple(sys.version_info[:2])]
+        for types_db in self.types_dbs:
+            st = os.stat(types_db)
+            key.append((os.path.abspath(types_db), st.st_mtime, st.st_size))
+        return tuple(key)
+
+    def _load_cache(self, cache_key):
+        try:
+            with open(self.cache_file, "rb") as f:
+                data = marshal.loads(f.read())
+            key, types, type_ranges, signatures, formats = data
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return False
+        if key != cache_key:
+            return False
+        self.types = types
+        self.type_ranges = type_ranges
+        self.type_signatures = signatures
+        structs = {None: None}
+        for name, fmt in formats.items():
+            value_struct = structs.get(fmt)
+            if value_struct is None and fmt is not None:
+                value_struct = structs[fmt] = struct.Struct(fmt)
+            self.value_structs[name] = value_struct
+        log.info("Loaded collectd types from cache %s", self.cache_file)
+        return True
+
+    def _save_cache(self, cache_key):
+        formats = {}
+        for name, value_struct in self.value_structs.items():
+            fmt = value_struct.format if value_struct is not None else None
+            if isinstance(fmt, bytes):
+                fmt = fmt.decode()  # Struct.format is bytes before Python 3.7
+            formats[name] = fmt
+        data = (cache_key, self.types, self.type_ranges, self.type_signatures, formats)
+        # Workers starting at once each write a file of their own
+        tmp_filename = "%s.%d.tmp" % (self.cache_file, os.getpid())
+        try:
+            with open(tmp_filename, "wb") as f:
+                f.write(marshal.dumps(data))
+            os.rename(tmp_filename, self.cache_file)
+        except (IOError, OSError):
+            log.exception("Unable to write collectd types cache %s", self.cache_file)
+            if os.path.exists(tmp_filename):
+                os.unlink(tmp_filename)
 
     def _add_type_line(self, line):
         types = {
@@ -145,12 +259,77 @@ class CollectDTypes(object):
             maxv = None if maxv == "U" else float(maxv)
             self.types[name].append((vname, vtype))
             self.type_ranges[name][vname] = (minv, maxv)
+        self._compile_type(name)
+
+    def _compile_type(self, name):
+        vtypes = [vtype for vname, vtype in self.types[name]]
+        # The type bytes a values part of this type starts with
+        self.type_signatures[name] = bytes(bytearray(vtypes))
+        orders = set(self.value_formats[vtype][0] for vtype in vtypes)
+        if len(orders) == 1:
+            fmt = orders.pop() + "".join(self.value_formats[vtype][1] for vtype in vtypes)
+            self.value_structs[name] = struct.Struct(fmt)
+        else:
+            # Values with different byte orders can't share one struct
+            self.value_structs[name] = None
+
+
+class CollectDFilter(object):
+    """
+    Allow and deny rules on the plugin, type and type_instance of values.
+
+    A rule is a "plugin/type/type_instance" string of shell style patterns,
+    left out trailing fields match anything, e.g. "cpu" or "interface/if_errors".
+    Values are kept when they match an allow rule, or there are none, and
+    match no deny rule. Decisions are cached per plugin, type and
+    type_instance.
+    """
+
+    def __init__(self, allow=(), deny=(), cache_size=10000):
+        self.allow = [self.compile(rule) for rule in allow]
+        self.deny = [self.compile(rule) for rule in deny]
+        self.cache_size = cache_size
+        self.cache = {}
+
+    @staticmethod
+    def compile(rule):
+        fields = rule.split("/")
+        if len(fields) > 3:
+            raise ConfigError("Invalid collectd filter rule: %s" % rule)
+        return [re.compile(fnmatch.translate(field)).match for field in fields]
+
+    @staticmethod
+    def matches(rules, fields):
+        for rule in rules:
+            if all(match(field) for match, field in zip(rule, fields)):
+                return True
+        return False
+
+    def accepts(self, plugin, stype, type_instance):
+        key = (plugin, stype, type_instance)
+        try:
+            return self.cache[key]
+        except KeyError:
+            pass
+        if self.allow and not self.matches(self.allow, key):
+            accept = False
+        else:
+            accept = not self.matches(self.deny, key)
+        if len(self.cache) >= self.cache_size:
+            self.cache.clear()
+        self.cache[key] = accept
+        return accept
 
 
 class CollectDParser(object):
-    def __init__(self, types_dbs=[], counter_eq_derive=False):
-        self.types = CollectDTypes(types_dbs=types_dbs)
+    header_struct = struct.Struct("!HH")
+    # Header parts the filter decides on
+    filter_parts = frozenset([0x0002, 0x0004, 0x0005])
+
+    def __init__(self, types_dbs=[], counter_eq_derive=False, types_cache=None, part_filter=None):
+        self.types = CollectDTypes(types_dbs=types_dbs, cache_file=types_cache)
         self.counter_eq_derive = counter_eq_derive
+        self.part_filter = part_filter
 
     def parse(self, data):
         for sample in self.parse_samples(data):
@@ -169,19 +348,34 @@ class CollectDParser(object):
             0x0007: self._parse_time("interval"),
             0x0009: self._parse_time_hires("interval")
         }
-        sample = {}
+        header = {}
+        shared = False
+        part_filter = self.part_filter
+        filter_parts = self.filter_parts
+        accept = True
         for (ptype, data) in self.parse_data(data):
             if ptype not in types:
                 log.debug("Ignoring part type: 0x%02x", ptype)
                 continue
             if ptype != 0x0006:
-                types[ptype](sample, data)
+                if shared:
+                    # Samples already yielded keep the previous header
+                    header = dict(header)
+                    shared = False
+                types[ptype](header, data)
+                if ptype in filter_parts:
+                    accept = None
                 continue
-            for vname, vtype, val in self.parse_values(sample["type"], data):
-                sample["value_name"] = vname
-                sample["value_type"] = vtype
-                sample["value"] = val
-                yield copy.deepcopy(sample)
+            if part_filter is not None:
+                # Rejected values are skipped without decoding them
+                if accept is None:
+                    accept = part_filter.accepts(header.get("plugin", ""), header.get("type", ""),
+                                                 header.get("type_instance", ""))
+                if not accept:
+                    continue
+            shared = True
+            for vname, vtype, val in self.parse_values(header["type"], data):
+                yield CollectDSample(header, vname, vtype, val)
 
     def parse_data(self, data):
         types = set([
@@ -189,33 +383,47 @@ class CollectDParser(object):
             0x0005, 0x0006, 0x0007, 0x0008, 0x0009,
             0x0100, 0x0101, 0x0200, 0x0210
         ])
-        while len(data) > 0:
-            if len(data) < 4:
+        # Parts are yielded as views on the packet, nothing is copied
+        data = memoryview(data)
+        unpack_header = self.header_struct.unpack_from
+        offset, end = 0, len(data)
+        while offset < end:
+            if end - offset < 4:
                 raise ProtocolError("Truncated header.")
-            (part_type, part_len) = struct.unpack("!HH", data[:4])
-            data = data[4:]
+            (part_type, part_len) = unpack_header(data, offset)
             if part_type not in types:
                 raise ProtocolError("Invalid part type: 0x%02x" % part_type)
-            part_len -= 4  # includes four header bytes we just parsed
-            if len(data) < part_len:
+            if part_len < 4:  # includes the four header bytes
+                raise ProtocolError("Invalid part length.")
+            if end - offset < part_len:
                 raise ProtocolError("Truncated value.")
-            part_data, data = data[:part_len], data[part_len:]
-            yield (part_type, part_data)
+            yield (part_type, data[offset + 4:offset + part_len])
+            offset += part_len
 
     def parse_values(self, stype, data):
-        types = {0: "!Q", 1: "<d", 2: "!q", 3: "!Q"}
-        (nvals,) = struct.unpack("!H", data[:2])
-        data = data[2:]
-        if len(data) != 9 * nvals:
+        (nvals,) = struct.unpack_from("!H", data)
+        if len(data) != 2 + 9 * nvals:
             raise ProtocolError("Invalid value structure length.")
         vtypes = self.types.get(stype)
         if nvals != len(vtypes):
             raise ProtocolError("Values different than types.db info.")
-        for i in range(nvals):
-            if six.PY3:
-                vtype = data[i]
-            else:
-                (vtype,) = struct.unpack("B", data[i])
+        if data[2:2 + nvals].tobytes() != self.types.type_signatures[stype]:
+            self.check_value_types(stype, vtypes, data, nvals)
+        value_struct = self.types.value_structs[stype]
+        if value_struct is not None:
+            vals = value_struct.unpack_from(data, 2 + nvals)
+        else:
+            vals = []
+            offset = 2 + nvals
+            for vname, vtype in vtypes:
+                order, fmt = self.types.value_formats[vtype]
+                vals.append(struct.unpack_from(order + fmt, data, offset)[0])
+                offset += 8
+        for (vname, vtype), val in zip(vtypes, vals):
+            yield vname, vtype, val
+
+    def check_value_types(self, stype, vtypes, data, nvals):
+        for i, vtype in enumerate(struct.unpack_from("!%dB" % nvals, data, 2)):
             if vtype != vtypes[i][1]:
                 if self.counter_eq_derive and \
                    (vtype, vtypes[i][1]) in ((0, 2), (2, 0)):
@@ -224,14 +432,10 @@ class CollectDParser(object):
                               stype, vtypes[i][0])
                 else:
                     raise ProtocolError("Type mismatch with types.db")
-        data = data[nvals:]
-        for i in range(nvals):
-            vdata, data = data[:8], data[8:]
-            (val,) = struct.unpack(types[vtypes[i][1]], vdata)
-            yield vtypes[i][0], vtypes[i][1], val
 
     def _parse_string(self, name):
         def _parser(sample, data):
+            data = data.tobytes()
             if six.PY3:
                 data = data.decode()
             if data[-1] != '\0':
@@ -243,7 +447,7 @@ class CollectDParser(object):
         def _parser(sample, data):
             if len(data) != 8:
                 raise ProtocolError("Invalid time data length.")
-            (val,) = struct.unpack("!Q", data)
+            (val,) = struct.unpack_from("!Q", data)
             sample[name] = float(val)
         return _parser
 
@@ -251,11 +455,192 @@ class CollectDParser(object):
         def _parser(sample, data):
             if len(data) != 8:
                 raise ProtocolError("Invalid hires time data length.")
-            (val,) = struct.unpack("!Q", data)
+            (val,) = struct.unpack_from("!Q", data)
             sample[name] = val * (2 ** -30)
         return _parser
 
 
+class CollectDWriter(object):
+    """
+    Encodes collectd samples into network protocol packets.
+
+    Header parts are only written when they differ from the previous value
+    in the same packet, like collectd does, and parts are added to a packet
+    until the next one would exceed the MTU. Packets are signed when a user
+    name and password are given.
+    """
+
+    string_parts = (("host", 0x0000), ("plugin", 0x0002), ("plugin_instance", 0x0003),
+                    ("type", 0x0004), ("type_instance", 0x0005))
+    time_parts = (("time", 0x0008), ("interval", 0x0009))
+    header_struct = struct.Struct("!HH")
+    time_struct = struct.Struct("!HHQ")
+    values_header_struct = struct.Struct("!HHH")
+    value_structs = dict((vtype, struct.Struct(order + fmt))
+                         for vtype, (order, fmt) in CollectDTypes.value_formats.items())
+
+    def __init__(self, mtu=1452, username=None, password=None):
+        self.mtu = mtu
+        self.packets = []
+        self.parts = []
+        self.size = 0
+        self.state = {}
+        if username:
+            self.username = _bytes(username)
+            self.mac = hmac.new(_bytes(password), digestmod=sha256)
+            self.max_size = mtu - (4 + 32 + len(self.username))
+        else:
+            self.username = None
+            self.max_size = mtu
+
+    def add(self, header, values):
+        """Add the [(value type, value)] of one values part with its header fields"""
+        values_part = self.encode_values(values)
+        header_parts = self.encode_header(header, self.state)
+        size = len(values_part) + sum(len(part) for part in header_parts)
+        if self.parts and self.size + size > self.max_size:
+            self.flush()
+            header_parts = self.encode_header(header, self.state)
+            size = len(values_part) + sum(len(part) for part in header_parts)
+        self.parts.extend(header_parts)
+        self.parts.append(values_part)
+        self.size += size
+
+    def flush(self):
+        """Finish the packet being written"""
+        if not self.parts:
+            return
+        payload = b"".join(self.parts)
+        if self.username is not None:
+            mac = self.mac.copy()
+            mac.update(self.username + payload)
+            payload = b"".join((self.header_struct.pack(0x0200, 4 + 32 + len(self.username)),
+                                mac.digest(), self.username, payload))
+        self.packets.append(payload)
+        self.parts = []
+        self.size = 0
+        self.state = {}
+
+    def take(self):
+        """Return and forget the finished packets"""
+        packets, self.packets = self.packets, []
+        return packets
+
+    def encode_header(self, header, state):
+        parts = []
+        for name, ptype in self.time_parts:
+            value = header.get(name)
+            if value is not None and state.get(name) != value:
+                state[name] = value
+                parts.append(self.time_struct.pack(ptype, 12, int(value * (2 ** 30))))
+        for name, ptype in self.string_parts:
+            value = header.get(name)
+            if value is None:
+                if not state.get(name):
+                    continue
+                value = ""  # reset what an earlier sample set
+            if state.get(name) != value:
+                state[name] = value
+                data = _bytes(value) + b"\0"
+                parts.append(self.header_struct.pack(ptype, 4 + len(data)) + data)
+        return parts
+
+    def encode_values(self, values):
+        value_structs = self.value_structs
+        nvals = len(values)
+        parts = [self.values_header_struct.pack(0x0006, 4 + 2 + 9 * nvals, nvals),
+                 bytes(bytearray(vtype for vtype, value in values))]
+        parts.extend(value_structs[vtype].pack(value) for vtype, value in values)
+        return b"".join(parts)
+
+
+class CollectDForwarder(object):
+    """
+    Forwards the parsed collectd samples to another collectd server or bucky.
+
+    Samples are written by CollectDWriter, a packet is sent once it is full
+    or when it was started more than the forward interval ago. Without new
+    packets the due packet is sent by a flusher thread, started with the
+    first buffered packet in the process that receives them.
+    """
+
+    def __init__(self, cfg):
+        self.addr = (cfg.collectd_forward_ip, cfg.collectd_forward_port)
+        addrinfo = socket.getaddrinfo(self.addr[0], self.addr[1], socket.AF_UNSPEC, socket.SOCK_DGRAM)
+        af, socktype, proto, canonname, self.addr = addrinfo[0]
+        self.sock = socket.socket(af, socket.SOCK_DGRAM)
+        self.writer = CollectDWriter(cfg.collectd_forward_mtu,
+                                     cfg.collectd_forward_username,
+                                     cfg.collectd_forward_password)
+        self.interval = cfg.collectd_forward_interval
+        self.next_flush = None
+        # Guards the writer shared with the flusher thread
+        self.lock = threading.Lock()
+        self.flusher = None
+        self.header = None
+        self.values = []
+        self.value_names = set()
+
+    def add(self, sample):
+        # Consecutive values of one values part are written as one again
+        if sample.header is not self.header or sample.value_name in self.value_names:
+            self.end_part()
+            self.header = sample.header
+        self.values.append((sample.value_type, sample.value))
+        self.value_names.add(sample.value_name)
+
+    def end_part(self):
+        if self.values:
+            with self.lock:
+                self.writer.add(self.header, self.values)
+            self.values = []
+            self.value_names = set()
+        self.header = None
+
+    def end_packet(self):
+        """Called after every received packet, sends what is due"""
+        self.end_part()
+        with self.lock:
+            if self.writer.parts:
+                now = time.time()
+                if self.next_flush is None:
+                    self.next_flush = now + self.interval
+                    if self.flusher is None and self.interval > 0:
+                        self.flusher = threading.Thread(target=self.run_flusher)
+                        self.flusher.daemon = True
+                        self.flusher.start()
+                if now >= self.next_flush:
+                    self.writer.flush()
+                    self.next_flush = None
+            self.send()
+
+    def run_flusher(self):
+        """Sends the due packet when no new packets arrive"""
+        while True:
+            with self.lock:
+                now = time.time()
+                if self.next_flush is not None and now >= self.next_flush:
+                    self.writer.flush()
+                    self.next_flush = None
+                    self.send()
+                delay = self.interval if self.next_flush is None else self.next_flush - now
+            time.sleep(delay)
+
+    def flush(self):
+        self.end_part()
+        with self.lock:
+            self.writer.flush()
+            self.next_flush = None
+            self.send()
+
+    def send(self):
+        for packet in self.writer.take():
+            try:
+                self.sock.sendto(packet, self.addr)
+            except socket.error:
+                log.exception("Failed to forward collectd packet to %s:%s", *self.addr[:2])
+
+
 class CollectDCrypto(object):
     def __init__(self, cfg):
         sec_level = cfg.collectd_security_level
@@ -267,6 +652,8 @@ class CollectDCrypto(object):
             self.sec_level = 0
         self.auth_file = cfg.collectd_auth_file
         self.auth_db = {}
+        # Key material derived from the passwords, by raw user name
+        self.user_keys = {}
         self.cfg_mon = None
         self.crypto_backend = default_backend()
         if self.auth_file:
@@ -286,6 +673,7 @@ class CollectDCrypto(object):
         except IOError as exc:
             raise ConfigError("Unable to load collectd's auth file: %r" % exc)
         self.auth_db.clear()
+        self.user_keys.clear()
         for line in f:
             line = line.strip()
             if not line or line[0] == "#":
@@ -325,18 +713,33 @@ class CollectDCrypto(object):
         if sec_level == 2:
             return self.parse_encrypted(part_len, data)
 
+    def user_key(self, uname):
+        """HMAC and AES key of a user, derived once per auth file load"""
+        keys = self.user_keys.get(uname)
+        if keys is None:
+            password = self.auth_db.get(uname.decode())
+            if password is None:
+                return None
+            password = password.encode()
+            # Signatures copy the keyed HMAC instead of keying a new one
+            keys = (hmac.new(password, digestmod=sha256),
+                    algorithms.AES(sha256(password).digest()))
+            self.user_keys[uname] = keys
+        return keys
+
     def parse_signed(self, part_len, data):
         if part_len <= 32:
             raise ProtocolError("Truncated signed part.")
         sig, data = data[:32], data[32:]
         uname_len = part_len - 32
-        uname = data[:uname_len].decode()
-        if uname not in self.auth_db:
-            raise ProtocolError("Signed packet, unknown user '%s'" % uname)
-        password = self.auth_db[uname].encode()
-        sig2 = hmac.new(password, msg=data, digestmod=sha256).digest()
-        if not self._hashes_match(sig, sig2):
-            raise ProtocolError("Bad signature from user '%s'" % uname)
+        uname = data[:uname_len]
+        keys = self.user_key(uname)
+        if keys is None:
+            raise ProtocolError("Signed packet, unknown user '%s'" % uname.decode())
+        mac = keys[0].copy()
+        mac.update(data)
+        if not self._hashes_match(sig, mac.digest()):
+            raise ProtocolError("Bad signature from user '%s'" % uname.decode())
         data = data[uname_len:]
         return data
 
@@ -348,61 +751,75 @@ class CollectDCrypto(object):
         uname_len, data = struct.unpack("!H", data[:2])[0], data[2:]
         if len(data) <= uname_len + 36:
             raise ProtocolError("Truncated encrypted part.")
-        uname, data = data[:uname_len].decode(), data[uname_len:]
-        if uname not in self.auth_db:
-            raise ProtocolError("Couldn't decrypt, unknown user '%s'" % uname)
+        uname, data = data[:uname_len], data[uname_len:]
+        keys = self.user_key(uname)
+        if keys is None:
+            raise ProtocolError("Couldn't decrypt, unknown user '%s'" % uname.decode())
         iv, data = data[:16], data[16:]
-        password = self.auth_db[uname].encode()
-        key = sha256(password).digest()
-        pad_bytes = 16 - (len(data) % 16)
-        data += b'\0' * pad_bytes
-        cipher = Cipher(algorithms.AES(key), modes.OFB(iv), backend=self.crypto_backend)
-        decryptor = cipher.decryptor()
-        data = decryptor.update(data)
-        data = data[:-pad_bytes]
+        # OFB is a stream mode, the payload needs no padding
+        cipher = Cipher(keys[1], OFB(iv), backend=self.crypto_backend)
+        data = cipher.decryptor().update(data)
         tag, data = data[:20], data[20:]
         tag2 = sha1(data).digest()
         if not self._hashes_match(tag, tag2):
-            raise ProtocolError("Bad checksum on enc pkt for '%s'" % uname)
+            raise ProtocolError("Bad checksum on enc pkt for '%s'" % uname.decode())
         return data
 
     def _hashes_match(self, a, b):
-        """Constant time comparison of bytes for py3, strings for py2"""
-        if len(a) != len(b):
-            return False
-        diff = 0
-        if six.PY2:
-            a = bytearray(a)
-            b = bytearray(b)
-        for x, y in zip(a, b):
-            diff |= x ^ y
-        return not diff
+        """Constant time comparison of the digests"""
+        return hmac.compare_digest(a, b)
 
 
 class CollectDConverter(object):
     def __init__(self, cfg):
+        if cfg.collectd_name_cache_size:
+            self.name_cache = LRUCache(cfg.collectd_name_cache_size)
+        else:
+            self.name_cache = None
+        self.reload(cfg)
+
+    def reload(self, cfg):
         self.converters = dict(DEFAULT_CONVERTERS)
+        if self.name_cache is not None:
+            self.name_cache.clear()
         self._load_converters(cfg)
 
     def convert(self, sample):
+        header = sample.header
+        cache = self.name_cache
+        if cache is None:
+            name = self.convert_name(sample)
+        else:
+            key = (header.get("host"), header.get("plugin"), header.get("plugin_instance"),
+                   header.get("type"), header.get("type_instance"), sample.value_name)
+            name = cache.get(key, self)
+            if name is self:
+                name = self.convert_name(sample)
+                if name is not False:
+                    cache.set(key, name)
+        if not name:
+            return
+        return (
+            header.get("host", ""),
+            name,
+            sample.value_type,
+            sample.value,
+            int(header["time"])
+        )
+
+    def convert_name(self, sample):
+        """Return the metric name for sample, None if it should be ignored
+        and False if the converter failed."""
         default = self.converters["_default"]
         handler = self.converters.get(sample["plugin"], default)
         try:
             name_parts = handler(sample)
             if name_parts is None:
                 return  # treat None as "ignore sample"
-            name = '.'.join(name_parts)
+            return '.'.join(name_parts)
         except Exception:
             log.exception("Exception in sample handler  %s (%s):", sample["plugin"], handler)
-            return
-        host = sample.get("host", "")
-        return (
-            host,
-            name,
-            sample["value_type"],
-            sample["value"],
-            int(sample["time"])
-        )
+            return False
 
     def _load_converters(self, cfg):
         cfg_conv = cfg.collectd_converters
@@ -417,6 +834,8 @@ class CollectDConverter(object):
             self._add_converter(name, klass, source=ep.module_name)
 
     def _add_converter(self, name, inst, source="unknown"):
+        if self.name_cache is not None:
+            self.name_cache.clear()
         if name not in self.converters:
             log.info("Converter: %s from %s", name, source)
             self.converters[name] = inst
@@ -432,42 +851,338 @@ class CollectDConverter(object):
                  name, inst, source, kpriority, ipriority)
 
 
+class CollectDSamplesFile(object):
+    """
+    Binary snapshot of the previous samples of a CollectDHandler.
+
+    A header holding a magic, a version and the number of records is
+    followed by one record per (host, name) key: the lengths of host and
+    name, the kind of value, the sample time, the UTF-8 encoded host and
+    name and the value as 8 bytes.
+    """
+
+    MAGIC = b"BKCD"
+    VERSION = 1
+    header_struct = struct.Struct("!4sBI")
+    record_struct = struct.Struct("!HHBq")
+    # Kinds of values, counters are unsigned and derives signed 64 bit
+    value_structs = (struct.Struct("!q"), struct.Struct("!Q"), struct.Struct("!d"))
+
+    @classmethod
+    def write(cls, filename, samples):
+        record_struct = cls.record_struct
+        signed, unsigned, double = cls.value_structs
+        chunks = [cls.header_struct.pack(cls.MAGIC, cls.VERSION, len(samples))]
+        for (host, name), (val, stime) in samples.items():
+            host, name = _bytes(host), _bytes(name)
+            if isinstance(val, float):
+                kind, value = 2, double.pack(val)
+            elif val < 0:
+                kind, value = 0, signed.pack(val)
+            else:
+                kind, value = 1, unsigned.pack(val)
+            chunks.append(record_struct.pack(len(host), len(name), kind, int(stime)))
+            chunks.extend((host, name, value))
+        tmp_filename = filename + ".tmp"
+        with open(tmp_filename, "wb") as f:
+            f.write(b"".join(chunks))
+        os.rename(tmp_filename, filename)
+
+    @classmethod
+    def read(cls, filename, min_time=None):
+        """Yield ((host, name), (value, time)), skipping samples before min_time"""
+        with open(filename, "rb") as f:
+            data = f.read()
+        header_size = cls.header_struct.size
+        if len(data) < header_size:
+            raise ProtocolError("Truncated samples file.")
+        magic, version, count = cls.header_struct.unpack_from(data)
+        if magic != cls.MAGIC or version != cls.VERSION:
+            raise ProtocolError("Unknown samples file format.")
+        record_struct = cls.record_struct
+        value_structs = cls.value_structs
+        offset = header_size
+        for i in range(count):
+            if offset + record_struct.size > len(data):
+                raise ProtocolError("Truncated samples file.")
+            host_len, name_len, kind, stime = record_struct.unpack_from(data, offset)
+            offset += record_struct.size
+            end = offset + host_len + name_len + 8
+            if end > len(data) or kind >= len(value_structs):
+                raise ProtocolError("Truncated samples file.")
+            host = _str(data[offset:offset + host_len])
+            name = _str(data[offset + host_len:end - 8])
+            (val,) = value_structs[kind].unpack_from(data, end - 8)
+            offset = end
+            if min_time is None or stime >= min_time:
+                yield (host, name), (val, stime)
+
+
+if six.PY3:
+    def _bytes(data):
+        return data.encode("utf-8")
+
+    def _str(data):
+        return data.decode("utf-8")
+else:
+    def _bytes(data):
+        if isinstance(data, six.text_type):
+            return data.encode("utf-8")
+        return data
+
+    def _str(data):
+        return data
+
+
+class CollectDRollup(object):
+    """
+    Aggregates the samples of every series over windows aligned to
+    multiples of window seconds, emitting one sample per window stamped
+    with its start. A window is emitted when a sample of a later window
+    arrives, or once it ended more than a window ago.
+    """
+
+    functions = {
+        "avg": lambda acc, val: acc + val,
+        "min": min,
+        "max": max,
+        "last": lambda acc, val: val,
+    }
+
+    def __init__(self, window, function="avg"):
+        if function not in self.functions:
+            raise ConfigError("Invalid collectd rollup function: %s" % function)
+        self.window = window
+        self.function = function
+        self.combine = self.functions[function]
+        # (host, name) -> [window start, aggregate, count]
+        self.series = {}
+        self.next_expire = 0
+
+    def add(self, host, name, val, stime):
+        """Add a sample, returns the sample of a finished window or None"""
+        start = stime - stime % self.window
+        key = (host, name)
+        state = self.series.get(key)
+        if state is None:
+            self.series[key] = [start, val, 1]
+            return
+        if start <= state[0]:
+            # Late samples count to the window being aggregated
+            state[1] = self.combine(state[1], val)
+            state[2] += 1
+            return
+        self.series[key] = [start, val, 1]
+        return self.sample(key, state)
+
+    def sample(self, key, state):
+        start, val, count = state
+        if self.function == "avg":
+            val = float(val) / count
+        return key[0], key[1], val, start
+
+    def expire(self, now=None):
+        """Emit the windows that ended more than a window before now"""
+        if now is None:
+            now = time.time()
+        if now < self.next_expire:
+            return []
+        self.next_expire = now + self.window
+        min_start = now - 2 * self.window
+        expired = [(key, state) for key, state in self.series.items() if state[0] < min_start]
+        for key, state in expired:
+            del self.series[key]
+        return [self.sample(key, state) for key, state in expired]
+
+    def flush(self):
+        """Emit all windows, finished or not"""
+        samples = [self.sample(key, state) for key, state in self.series.items()]
+        self.series = {}
+        return samples
+
+
 class CollectDHandler(object):
     """Wraps all CollectD parsing functionality in a class"""
 
-    def __init__(self, cfg):
+    def __init__(self, cfg, id_num=None):
         self.crypto = CollectDCrypto(cfg)
+        if cfg.collectd_types_cache:
+            types_cache = os.path.join(cfg.directory, cfg.collectd_types_cache)
+        else:
+            types_cache = None
+        if cfg.collectd_filter_allow or cfg.collectd_filter_deny:
+            part_filter = CollectDFilter(cfg.collectd_filter_allow, cfg.collectd_filter_deny)
+        else:
+            part_filter = None
         self.parser = CollectDParser(cfg.collectd_types,
-                                     cfg.collectd_counter_eq_derive)
+                                     cfg.collectd_counter_eq_derive,
+                                     types_cache, part_filter)
         self.converter = CollectDConverter(cfg)
         self.prev_samples = {}
         self.last_sample = None
+        if cfg.collectd_forward_ip:
+            self.forwarder = CollectDForwarder(cfg)
+        else:
+            self.forwarder = None
+        if cfg.collectd_rollup_window:
+            self.rollup = CollectDRollup(cfg.collectd_rollup_window, cfg.collectd_rollup_function)
+        else:
+            self.rollup = None
 
-    def parse(self, data):
+        self.persistent_samples = cfg.collectd_persistent_samples
+        self.samples_savefile = os.path.join(cfg.directory, cfg.collectd_samples_savefile)
+        if id_num is None:
+            self.samples_filename = self.samples_savefile
+        else:
+            # Every worker saves the samples it holds to a file of its own
+            self.samples_filename = "%s.%d" % (self.samples_savefile, id_num)
+        self.samples_max_age = cfg.collectd_samples_max_age
+        self.samples_ttl = cfg.collectd_samples_ttl
+        self.samples_interval = cfg.collectd_samples_save_interval
+        self.next_samples_check = time.time() + self.samples_interval
+        self.samples_check = self.samples_interval and (self.persistent_samples or self.samples_ttl)
+        # Loaded samples, dropped when their series aren't seen again in time
+        self.loaded_samples = None
+        self.loaded_expire = 0
+        self.load_samples()
+
+    def load_samples(self):
+        if not self.persistent_samples:
+            return
+        # The samples of a host may have been held by any worker before, so
+        # all snapshots are loaded. Samples of series that don't come to
+        # this worker are dropped again after max age seconds.
+        prefix = self.samples_savefile + "."
+        filenames = [self.samples_savefile]
+        filenames.extend(sorted(name for name in glob.glob(prefix + "*")
+                                if name[len(prefix):].isdigit()))
+        if self.samples_max_age:
+            min_time = time.time() - self.samples_max_age
+        else:
+            min_time = None
+        for filename in filenames:
+            if not os.path.isfile(filename):
+                continue
+            log.info("CollectD: Loading saved samples %s", filename)
+            try:
+                self.add_samples(CollectDSamplesFile.read(filename, min_time))
+            except (IOError, ProtocolError) as e:
+                log.error("CollectD: Failed to load samples %s: %s", filename, e)
+        keep = self.samples_max_age or self.samples_ttl
+        if self.prev_samples and keep:
+            self.loaded_samples = dict(self.prev_samples)
+            self.loaded_expire = time.time() + keep
+
+    def drop_loaded_samples(self):
+        """Forget the loaded samples of series not updated since loading"""
+        prev_samples = self.prev_samples
+        dropped = 0
+        for key, sample in self.loaded_samples.items():
+            if prev_samples.get(key) is sample:
+                del prev_samples[key]
+                dropped += 1
+        self.loaded_samples = None
+        if dropped:
+            log.info("CollectD: Dropped %d loaded samples not seen since startup", dropped)
+
+    def add_samples(self, samples):
+        """Take over (key, sample) pairs, keeping the newer of two samples"""
+        prev_samples = self.prev_samples
+        for key, sample in samples:
+            prev = prev_samples.get(key)
+            if prev is None or prev[1] < sample[1]:
+                prev_samples[key] = sample
+
+    def pop_samples(self, hosts):
+        """Remove and return the (key, sample) pairs of hosts"""
+        keys = [key for key in self.prev_samples if key[0] in hosts]
+        return [(key, self.prev_samples.pop(key)) for key in keys]
+
+    def save_samples(self):
+        if not self.persistent_samples:
+            return
+        try:
+            CollectDSamplesFile.write(self.samples_filename, self.prev_samples)
+        except (IOError, OSError):
+            log.exception("CollectD: IOError")
+
+    def expire_samples(self, now):
+        """Forget the previous samples of series idle for longer than the TTL"""
+        if not self.samples_ttl:
+            return
+        min_time = now - self.samples_ttl
+        expired = [k for k, (v, stime) in self.prev_samples.items() if stime < min_time]
+        for k in expired:
+            del self.prev_samples[k]
+        if expired:
+            log.debug("CollectD: Expired %d idle samples", len(expired))
+
+    def check_samples(self):
+        """Expire and save the previous samples every save interval"""
+        now = time.time()
+        if now < self.next_samples_check:
+            return
+        self.next_samples_check = now + self.samples_interval
+        if self.loaded_samples is not None and now >= self.loaded_expire:
+            self.drop_loaded_samples()
+        self.expire_samples(now)
+        self.save_samples()
+
+    def parse(self, data, hosts=None):
+        """Yield the converted samples of a packet, adding their hosts to hosts if given"""
+        if self.samples_check:
+            self.check_samples()
         try:
             data = self.crypto.parse(data)
         except ProtocolError as e:
             log.error("Protocol error in CollectDCrypto: %s", e)
             return
+        forwarder = self.forwarder
+        rollup = self.rollup
+        if rollup is not None:
+            for sample in rollup.expire():
+                yield sample
         try:
             for sample in self.parser.parse(data):
                 self.last_sample = sample
+                if forwarder is not None:
+                    forwarder.add(sample)
                 stype = sample["type"]
                 vname = sample["value_name"]
                 sample = self.converter.convert(sample)
                 if sample is None:
                     continue
                 host, name, vtype, val, time = sample
+                if hosts is not None:
+                    hosts.add(host)
                 if not name.strip():
                     continue
                 val = self.calculate(host, name, vtype, val, time)
                 val = self.check_range(stype, vname, val)
-                if val is not None:
+                if val is None:
+                    continue
+                if rollup is None:
                     yield host, name, val, time
+                else:
+                    sample = rollup.add(host, name, val, time)
+                    if sample is not None:
+                        yield sample
         except ProtocolError as e:
             log.error("Protocol error: %s", e)
             if self.last_sample is not None:
                 log.info("Last sample: %s", self.last_sample)
+        finally:
+            if forwarder is not None:
+                forwarder.end_packet()
+
+    def shutdown(self):
+        """Save and flush the state of the handler, returns the samples still held"""
+        self.save_samples()
+        if self.forwarder is not None:
+            self.forwarder.flush()
+        if self.rollup is not None:
+            return self.rollup.flush()
+        return []
 
     def check_range(self, stype, vname, val):
         if val is None:
@@ -554,7 +1269,8 @@ class CollectDServer(UDPServer):
 
     def __init__(self, queue, cfg):
         super(CollectDServer, self).__init__(cfg.collectd_ip,
-                                             cfg.collectd_port)
+                                             cfg.collectd_port,
+                                             recv_buffer=cfg.collectd_recv_buffer)
         self.handler = CollectDHandler(cfg)
         self.queue = queue
 
@@ -563,31 +1279,65 @@ class CollectDServer(UDPServer):
             self.queue.put(sample)
         return True
 
+    def pre_shutdown(self):
+        for sample in self.handler.shutdown():
+            self.queue.put(sample)
+
 
 class CollectDWorker(multiprocessing.Process):
-    """CollectDWorker plugs a CollectDHandler between a pipe and a queue"""
+    """
+    CollectDWorker plugs a CollectDHandler between a pipe and a queue
+
+    Packets arrive as (source, data) pairs. For the migration of sources
+    between workers, (source, None) asks the worker to send back the
+    previous samples of the hosts seen from source and forget them, and
+    (source, samples) hands these samples to the new worker of source.
+    The samples are sent back over the replies pipe, never the one the
+    packets arrive on.
+    """
 
-    def __init__(self, pipe, queue, cfg, id_num=-1):
+    def __init__(self, pipe, replies, queue, cfg, id_num=-1):
         super(CollectDWorker, self).__init__()
         self.daemon = True
         self.name = "CollectDWorker%d" % id_num
+        self.id_num = id_num
         self.pipe = pipe
+        self.replies = replies
         self.queue = queue
         self.cfg = cfg
+        self.track_sources = cfg.collectd_balance_interval and cfg.collectd_balance_threshold
 
     def run(self):
+        # Restarted workers would inherit the handler of CollectDServerMP
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
         log.info("CollectDWorker up and running")
         setproctitle("bucky: %s" % self.name)
-        handler = CollectDHandler(self.cfg)
+        handler = CollectDHandler(self.cfg, self.id_num)
+        sources = {}
+        hosts = None
         while True:
             try:
-                data = self.pipe.recv()
+                msg = self.pipe.recv()
             except KeyboardInterrupt:
                 continue
-            if data is None:
+            except EOFError:
                 break
-            for sample in handler.parse(data):
-                self.queue.put(sample)
+            if msg is None:
+                break
+            source, data = msg
+            if isinstance(data, bytes):
+                if self.track_sources:
+                    hosts = sources.get(source)
+                    if hosts is None:
+                        hosts = sources[source] = set()
+                for sample in handler.parse(data, hosts):
+                    self.queue.put(sample)
+            elif data is None:
+                self.replies.send((source, handler.pop_samples(sources.pop(source, ()))))
+            else:
+                handler.add_samples(data)
+        for sample in handler.shutdown():
+            self.queue.put(sample)
 
 
 class CollectDServerMP(UDPServer):
@@ -595,52 +1345,265 @@ class CollectDServerMP(UDPServer):
 
     Starts a configurable (cfg.collectd_workers) number of worker processes.
     Routing of incoming packets to worker subsprocesses is performed by
-    consistent hashing, meaning that all packets from a given IP address will
-    always go to the same worker.
+    jump consistent hashing of the source IP address, meaning that all
+    packets from a given IP address go to the same worker, in every run.
+
+    The bytes received from every source are counted over
+    cfg.collectd_balance_interval seconds and published as the load of the
+    workers. When the busiest worker has more than
+    cfg.collectd_balance_threshold times the average load, sources are moved
+    from it to the least busy worker together with their counter state.
+    The old worker sends the counter state back on a pipe of its own, read
+    by a thread of the dispatcher, so neither of them waits for the other
+    to empty a pipe. Until it arrives, the packets of a moving source are held
+    back, at most cfg.process_join_timeout seconds. A source whose state
+    arrives later loses one rate per series, counted as
+    bucky.CollectDServerMP.lost_series.
+
+    The workers are checked every cfg.supervise_interval seconds, a dead
+    worker is restarted in its slot when cfg.collectd_restart_workers is set.
 
     """
 
     def __init__(self, queue, cfg):
         super(CollectDServerMP, self).__init__(cfg.collectd_ip,
-                                               cfg.collectd_port)
+                                               cfg.collectd_port,
+                                               recv_buffer=cfg.collectd_recv_buffer)
         self.daemon = False
         self.queue = queue
         self.cfg = cfg
         self.workers = []
+        self.next_supervise = 0
+        self.balance_interval = cfg.collectd_balance_interval
+        self.balance_threshold = cfg.collectd_balance_threshold
+        self.next_balance = 0
+        # Worker of every source seen in the current interval
+        self.routes = {}
+        # Workers of moved sources, overriding the hashing
+        self.moved = {}
+        self.source_load = {}
+        # Sources waiting for their state: [from, to, deadline, held back packets]
+        self.migrations = {}
+        # Sources moved without their state: (from, to, time out)
+        self.late = {}
+        self.lost_series = 0
+        # Previous samples sent back by the workers, (source, samples)
+        self.replies = six.moves.queue.Queue()
 
     def run(self):
         def sigterm_handler(signum, frame):
             log.info("Received SIGTERM")
             self.close()
 
-        self.workers = []
-        for i in range(self.cfg.collectd_workers):
-            recv, send = multiprocessing.Pipe()
-            worker = CollectDWorker(recv, self.queue, self.cfg, i)
-            worker.start()
-            self.workers.append((worker, send))
-
+        self.workers = [self.start_worker(i) for i in range(self.cfg.collectd_workers)]
+        self.next_supervise = time.time() + self.cfg.supervise_interval
+        if self.balance_interval:
+            self.next_balance = time.time() + self.balance_interval
+        else:
+            self.next_balance = float("inf")
         signal.signal(signal.SIGTERM, sigterm_handler)
         super(CollectDServerMP, self).run()
 
+    def start_worker(self, index):
+        recv, send = multiprocessing.Pipe(False)
+        replies_recv, replies_send = multiprocessing.Pipe(False)
+        worker = CollectDWorker(recv, replies_send, self.queue, self.cfg, index)
+        worker.start()
+        # Only the worker uses these ends, sending to a dead worker fails
+        # and reading the replies of a dead worker ends
+        recv.close()
+        replies_send.close()
+        reader = threading.Thread(target=self.read_replies, args=(replies_recv,))
+        reader.daemon = True
+        reader.start()
+        return worker, send
+
+    def read_replies(self, pipe):
+        """Queue the previous samples sent back by a worker until it exits"""
+        while True:
+            try:
+                self.replies.put(pipe.recv())
+            except (EOFError, IOError, OSError):
+                break
+        pipe.close()
+
+    def supervise(self):
+        self.next_supervise = time.time() + self.cfg.supervise_interval
+        for index, (worker, pipe) in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if not self.cfg.collectd_restart_workers:
+                log.error("Worker %s died, stopping server.", worker)
+                return False
+            log.error("Worker %s died with exit code %s, restarting.", worker, worker.exitcode)
+            pipe.close()
+            self.workers[index] = self.start_worker(index)
+        return True
+
+    def route(self, ip_addr):
+        index = self.moved.get(ip_addr)
+        if index is None:
+            index = jump_hash(stable_hash(ip_addr), len(self.workers))
+        self.routes[ip_addr] = index
+        return index
+
     def handle(self, data, addr):
         ip_addr, port = addr
-        # deterministically map source ip address to worker
-        index = hash(ip_addr) % len(self.workers)
-        worker, pipe = self.workers[index]
-        pipe.send(data)
-        # check if all is running
-        for worker, pipe in self.workers:
-            if not worker.is_alive():
-                log.error("Worker %s died, stopping server.", worker)
-                return
+        now = time.time()
+        if now >= self.next_balance:
+            self.balance(now)
+        if self.migrations or self.late:
+            self.check_migrations(now)
+        if self.balance_interval:
+            source_load = self.source_load
+            source_load[ip_addr] = source_load.get(ip_addr, 0) + len(data)
+        msg = (ip_addr, data)
+        if self.migrations and ip_addr in self.migrations:
+            self.migrations[ip_addr][3].append(msg)
+        else:
+            index = self.routes.get(ip_addr)
+            if index is None:
+                index = self.route(ip_addr)
+            try:
+                self.workers[index][1].send(msg)
+            except (IOError, OSError):
+                if not self.supervise():
+                    return
+                self.workers[index][1].send(msg)
+        if now >= self.next_supervise:
+            return self.supervise()
         return True
 
+    def balance(self, now):
+        """Publish the load of the workers and move sources off overloaded ones"""
+        elapsed = now - self.next_balance + self.balance_interval
+        self.next_balance = now + self.balance_interval
+        loads = [0] * len(self.workers)
+        sources = [[] for i in range(len(self.workers))]
+        for ip_addr, load in self.source_load.items():
+            index = self.routes.get(ip_addr)
+            if index is None:
+                # Held back for a migration
+                continue
+            loads[index] += load
+            sources[index].append((load, ip_addr))
+        for index, load in enumerate(loads):
+            name = "bucky.CollectDWorker%d.load" % index
+            self.queue.put((None, name, load / elapsed, int(now)))
+        if self.balance_threshold:
+            for ip_addr, src, dst in self.plan_migrations(loads, sources, self.balance_threshold):
+                self.migrate(ip_addr, src, dst, now)
+            self.queue.put((None, "bucky.CollectDServerMP.lost_series", self.lost_series, int(now)))
+            self.lost_series = 0
+            # Give up on the state of sources that timed out an interval ago
+            self.late = dict((ip_addr, late) for ip_addr, late in self.late.items()
+                             if late[2] >= now - self.balance_interval)
+        # Sources that went quiet are hashed again when they come back
+        self.moved = dict((ip_addr, index) for ip_addr, index in self.moved.items()
+                          if ip_addr in self.source_load)
+        self.routes = {}
+        self.source_load = {}
+
+    @staticmethod
+    def plan_migrations(loads, sources, threshold):
+        """
+        Pick the sources to move for worker loads and the (load, source)
+        pairs of every worker. Returns (source, from, to) tuples.
+        """
+        loads = list(loads)
+        mean = sum(loads) / float(len(loads))
+        sources = [sorted(s, reverse=True) for s in sources]
+        moves = []
+        while mean:
+            hot = loads.index(max(loads))
+            cold = loads.index(min(loads))
+            if loads[hot] <= mean * threshold:
+                break
+            # The biggest source that leaves both workers below the hot one,
+            # a single source hotter than that can't be split up
+            gap = loads[hot] - loads[cold]
+            for i, (load, ip_addr) in enumerate(sources[hot]):
+                if 0 < load < gap:
+                    break
+            else:
+                break
+            del sources[hot][i]
+            loads[hot] -= load
+            loads[cold] += load
+            moves.append((ip_addr, hot, cold))
+        return moves
+
+    def migrate(self, ip_addr, src, dst, now):
+        """Ask the worker of a source for its previous samples"""
+        try:
+            self.workers[src][1].send((ip_addr, None))
+        except (IOError, OSError):
+            log.warning("Failed to move %s from worker %d to %d", ip_addr, src, dst)
+            return
+        self.migrations[ip_addr] = [src, dst, now + self.cfg.process_join_timeout, []]
+
+    def check_migrations(self, now):
+        """Pass on the previous samples sent back by workers, time out the others"""
+        while True:
+            try:
+                source, samples = self.replies.get_nowait()
+            except six.moves.queue.Empty:
+                break
+            self.handover(source, samples)
+        for ip_addr, (src, dst, deadline, packets) in list(self.migrations.items()):
+            if now < deadline:
+                continue
+            log.warning("Worker %d didn't hand over %s in time, moving it without samples", src, ip_addr)
+            del self.migrations[ip_addr]
+            self.late[ip_addr] = (src, dst, now)
+            self.finish_migration(ip_addr, src, dst, [], packets)
+
+    def handover(self, ip_addr, samples):
+        migration = self.migrations.pop(ip_addr, None)
+        if migration is not None:
+            src, dst, deadline, packets = migration
+            self.finish_migration(ip_addr, src, dst, samples, packets)
+            return
+        late = self.late.pop(ip_addr, None)
+        if late is None:
+            return
+        # The new worker started the series over, the newer samples are kept
+        log.warning("Worker %d handed over %d series of %s late, losing a rate each",
+                    late[0], len(samples), ip_addr)
+        self.lost_series += len(samples)
+        try:
+            self.workers[late[1]][1].send((ip_addr, samples))
+        except (IOError, OSError):
+            pass
+
+    def finish_migration(self, ip_addr, src, dst, samples, packets):
+        """Send the previous samples of a source and its held back packets to its new worker"""
+        pipe = self.workers[dst][1]
+        try:
+            pipe.send((ip_addr, samples))
+            for msg in packets:
+                pipe.send(msg)
+        except (IOError, OSError):
+            log.warning("Failed to move %s from worker %d to %d", ip_addr, src, dst)
+            return
+        log.info("Moved %s with %d samples from worker %d to %d", ip_addr, len(samples), src, dst)
+        if dst == jump_hash(stable_hash(ip_addr), len(self.workers)):
+            self.moved.pop(ip_addr, None)
+        else:
+            self.moved[ip_addr] = dst
+        self.routes[ip_addr] = dst
+
     def pre_shutdown(self):
         log.info("Shutting down CollectDServer")
+        self.check_migrations(time.time())
+        for ip_addr, (src, dst, deadline, packets) in self.migrations.items():
+            self.finish_migration(ip_addr, src, dst, [], packets)
         for worker, pipe in self.workers:
             log.info("Stopping worker %s", worker)
-            pipe.send(None)
+            try:
+                pipe.send(None)
+            except (IOError, OSError):
+                pass
         for worker, pipe in self.workers:
             worker.join(self.cfg.process_join_timeout)
         for child in multiprocessing.active_children():
@@ -649,7 +1612,126 @@ class CollectDServerMP(UDPServer):
             child.join(1)
 
 
+class CollectDSocketWorker(UDPServer):
+    """
+    CollectDSocketWorker receives and parses a share of the CollectD traffic.
+
+    All workers bind the CollectD port with SO_REUSEPORT and the kernel
+    distributes the packets between them by hashing the source address and
+    port. A collectd daemon sends from a single socket, so all its packets
+    go to the same worker and the counter state of a host stays in one
+    prev_samples as long as the reuseport group does not change.
+    """
+
+    def __init__(self, queue, cfg, id_num=-1, sock=None):
+        super(CollectDSocketWorker, self).__init__(cfg.collectd_ip, cfg.collectd_port, reuseport=True,
+                                                   recv_buffer=cfg.collectd_recv_buffer, sock=sock)
+        self.name = "CollectDWorker%d" % id_num
+        self.id_num = id_num
+        self.drops_name = "bucky.%s.udp_drops" % self.name
+        self.queue = queue
+        self.cfg = cfg
+
+    def run(self):
+        def sigterm_handler(signum, frame):
+            raise SystemExit()
+
+        # Workers are stopped with terminate() by CollectDServerReusePort
+        signal.signal(signal.SIGTERM, sigterm_handler)
+        self.handler = CollectDHandler(self.cfg, self.id_num)
+        try:
+            super(CollectDSocketWorker, self).run()
+        finally:
+            for sample in self.handler.shutdown():
+                self.queue.put(sample)
+
+    def handle(self, data, addr):
+        for sample in self.handler.parse(data):
+            self.queue.put(sample)
+        return True
+
+
+class CollectDServerReusePort(multiprocessing.Process):
+    """Multiprocess CollectD server without a dispatcher
+
+    Starts a configurable (cfg.collectd_workers) number of
+    CollectDSocketWorker processes sharing the CollectD port. Packets
+    are not copied through this process, it only supervises the workers.
+
+    The sockets of the workers are kept open here for the lifetime of the
+    server. The kernel maps a source to a socket by its position in the
+    reuseport group, keeping every socket in the group keeps that mapping
+    and so the per host state of the workers stable. A restarted worker
+    takes over the socket of the dead one, including the packets queued
+    on it in the meantime.
+
+    """
+
+    def __init__(self, queue, cfg):
+        super(CollectDServerReusePort, self).__init__()
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ConfigError("collectd_reuseport requires SO_REUSEPORT support")
+        self.daemon = False
+        self.queue = queue
+        self.cfg = cfg
+        self.ip = cfg.collectd_ip
+        self.port = cfg.collectd_port
+        self.stop = multiprocessing.Event()
+        self.workers = []
+
+    def run(self):
+        def sigterm_handler(signum, frame):
+            log.info("Received SIGTERM")
+            self.close()
+
+        setproctitle("bucky: %s" % self.__class__.__name__)
+        # Bind every socket before any worker starts receiving
+        self.workers = [CollectDSocketWorker(self.queue, self.cfg, i)
+                        for i in range(self.cfg.collectd_workers)]
+        for worker in self.workers:
+            worker.start()
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+        while not self.stop.wait(self.cfg.supervise_interval):
+            if not self.supervise():
+                break
+        try:
+            self.pre_shutdown()
+        except Exception:
+            log.exception("Failed pre_shutdown method for %s",
+                          self.__class__.__name__)
+
+    def supervise(self):
+        for index, worker in enumerate(self.workers):
+            if worker.is_alive():
+                continue
+            if not self.cfg.collectd_restart_workers:
+                log.error("Worker %s died, stopping server.", worker)
+                return False
+            log.error("Worker %s died with exit code %s, restarting.", worker, worker.exitcode)
+            worker = CollectDSocketWorker(self.queue, self.cfg, index, sock=worker.sock)
+            worker.start()
+            self.workers[index] = worker
+        return True
+
+    def pre_shutdown(self):
+        log.info("Shutting down CollectDServer")
+        for worker in self.workers:
+            log.info("Stopping worker %s", worker)
+            worker.terminate()
+        for worker in self.workers:
+            worker.join(self.cfg.process_join_timeout)
+            worker.sock.close()
+
+    def close(self):
+        self.stop.set()
+
+
 def getCollectDServer(queue, cfg):
     """Get the appropriate collectd server (multi processed or not)"""
-    server = CollectDServerMP if cfg.collectd_workers > 1 else CollectDServer
-    return server(queue, cfg)
+    if cfg.collectd_workers > 1:
+        if cfg.collectd_reuseport:
+            return CollectDServerReusePort(queue, cfg)
+        return CollectDServerMP(queue, cfg)
+    return CollectDServer(queue, cfg)
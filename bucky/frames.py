@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+
+class SampleFrame(object):
+    """
+    A batch of samples sharing a host, a timestamp and default metadata.
+
+    Servers can put a single frame on the sample queue instead of one
+    message per sample. Iterating a frame yields the same
+    (host, name, value, time[, metadata]) tuples as the individual
+    samples would have been.
+    """
+
+    __slots__ = ("host", "time", "metadata", "stats")
+
+    def __init__(self, host, time, metadata=None, stats=None):
+        self.host = host
+        self.time = time
+        self.metadata = metadata
+        self.stats = stats if stats is not None else []
+
+    def __reduce__(self):
+        return (SampleFrame, (self.host, self.time, self.metadata, self.stats))
+
+    def __len__(self):
+        return len(self.stats)
+
+    def __iter__(self):
+        host, time, default = self.host, self.time, self.metadata
+        for stat in self.stats:
+            metadata = stat[2] if len(stat) > 2 else default
+            if metadata:
+                yield host, stat[0], stat[1], time, metadata
+            else:
+                yield host, stat[0], stat[1], time
+
+    def add(self, name, value, metadata=None):
+        if metadata is self.metadata:
+            self.stats.append((name, value))
+        else:
+            self.stats.append((name, value, metadata))
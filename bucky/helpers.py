@@ -1,4 +1,7 @@
 import os
+import struct
+import hashlib
+import collections
 import multiprocessing
 
 import watchdog.observers
@@ -36,3 +39,71 @@ class FileMonitor(object):
     def stop(self):
         self.observer.stop()
         self.observer.join(cfg.process_join_timeout)
+
+
+class LRUCache(object):
+    """Bounded mapping evicting the least recently used entries"""
+
+    def __init__(self, size):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self.data = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    if hasattr(collections.OrderedDict, "move_to_end"):
+        def get(self, key, default=None):
+            try:
+                value = self.data[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data.move_to_end(key)
+            self.hits += 1
+            return value
+    else:
+        def get(self, key, default=None):
+            try:
+                value = self.data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            self.data[key] = value
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        data = self.data
+        data.pop(key, None)
+        data[key] = value
+        if len(data) > self.size:
+            data.popitem(last=False)
+
+    def clear(self):
+        self.data.clear()
+
+
+def stable_hash(key):
+    """64 bit hash of a string, the same in every process and run"""
+    if not isinstance(key, bytes):
+        key = key.encode("utf-8")
+    return struct.unpack("!Q", hashlib.md5(key).digest()[:8])[0]
+
+
+def jump_hash(key, buckets):
+    """
+    Map a 64 bit key to one of buckets with jump consistent hashing
+    (Lamping and Veach). Going from n to n + 1 buckets moves only
+    1 / (n + 1) of the keys, all of them to the new bucket.
+    """
+    b, j = -1, 0
+    while j < buckets:
+        b = j
+        key = (key * 2862933555777941757 + 1) & 0xffffffffffffffff
+        j = int((b + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+    return b
@@ -20,6 +20,7 @@ import os
 import six
 import sys
 import pwd
+import time
 import grp
 import signal
 import logging
@@ -261,7 +262,7 @@ class Bucky(object):
         if cfg.collectd_enabled:
             stypes.append(collectd.getCollectDServer)
         if cfg.statsd_enabled:
-            stypes.append(statsd.StatsDServer)
+            stypes.append(statsd.getStatsDServer)
 
         self.servers = []
         for stype in stypes:
@@ -286,49 +287,64 @@ class Bucky(object):
             default_clients.append(influxdb.InfluxDBClient)
 
         self.clients = []
+        self.client_pipes = []
         for client in cfg.custom_clients + default_clients:
             send, recv = multiprocessing.Pipe()
             instance = client(cfg, recv)
             self.clients.append((instance, send))
+            self.client_pipes.append(recv)
 
     def run(self):
         def sigterm_handler(signum, frame):
             log.info("Received SIGTERM")
             self.psampleq.put(None)
 
+        # Clients first, later children must not inherit their pipes
+        for (client, pipe), recv in zip(self.clients, self.client_pipes):
+            client.start()
+            # Only the client reads the pipe, sending to a dead client fails
+            recv.close()
         for server in self.servers:
             server.start()
         if self.proc is not None:
             self.proc.start()
-        for client, pipe in self.clients:
-            client.start()
 
         signal.signal(signal.SIGTERM, sigterm_handler)
 
+        next_supervise = time.time() + cfg.supervise_interval
         while True:
             try:
                 sample = self.psampleq.get(True, 1)
-                if not sample:
+                if sample is None:
                     break
                 for instance, pipe in self.clients:
-                    if not instance.is_alive():
-                        self.shutdown("Client process died. Exiting.")
                     pipe.send(sample)
             except queue.Empty:
                 pass
             except IOError as exc:
                 # Probably due to interrupted system call by SIGTERM
+                # or a client that died
                 log.debug("Bucky IOError: %s", exc)
+                self.supervise()
                 continue
             except KeyboardInterrupt:
                 break
-            for srv in self.servers:
-                if not srv.is_alive():
-                    self.shutdown("Server thread died. Exiting.")
-            if self.proc is not None and not self.proc.is_alive():
-                self.shutdown("Processor thread died. Exiting.")
+            now = time.time()
+            if now >= next_supervise:
+                next_supervise = now + cfg.supervise_interval
+                self.supervise()
         self.shutdown()
 
+    def supervise(self):
+        for instance, pipe in self.clients:
+            if not instance.is_alive():
+                self.shutdown("Client process died. Exiting.")
+        for srv in self.servers:
+            if not srv.is_alive():
+                self.shutdown("Server thread died. Exiting.")
+        if self.proc is not None and not self.proc.is_alive():
+            self.shutdown("Processor thread died. Exiting.")
+
     def shutdown(self, err=''):
         log.info("Shutting down")
         for server in self.servers:
@@ -341,7 +357,10 @@ class Bucky(object):
             self.proc.join(cfg.process_join_timeout)
         for client, pipe in self.clients:
             log.info("Stopping client %s", client)
-            pipe.send(None)
+            try:
+                pipe.send(None)
+            except IOError:
+                pass  # the client is gone already
             client.join(cfg.process_join_timeout)
         children = [child for child in multiprocessing.active_children() if not child.name.startswith("SyncManager")]
         for child in children:
@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import math
+
+
+class DDSketch(object):
+    """
+    A mergeable quantile sketch with relative error guarantees. Based on
+    the DDSketch algorithm by Masson, Rim and Lee:
+
+      https://arxiv.org/abs/1908.10693
+
+    Values are counted in logarithmically sized buckets, any value returned
+    is within `relative_accuracy` of the exact value at that rank. Count,
+    sum, sum of squares, minimum and maximum are tracked exactly. Memory is
+    bounded by `max_bins` buckets per sign, when exceeded the buckets
+    holding the values closest to zero are collapsed together.
+    """
+
+    MIN_INDEXABLE = 1e-9
+
+    def __init__(self, relative_accuracy=0.01, max_bins=2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("Relative accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_bins = max_bins
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = math.log(self.gamma)
+        self.positive = {}
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.sum_squares = 0.0
+        self.min = None
+        self.max = None
+
+    def __len__(self):
+        return self.count
+
+    def update(self, val):
+        if val > self.MIN_INDEXABLE:
+            store = self.positive
+            key = self._key(val)
+        elif val < -self.MIN_INDEXABLE:
+            store = self.negative
+            key = self._key(-val)
+        else:
+            store = None
+        if store is None:
+            self.zero_count += 1
+        elif key in store:
+            store[key] += 1
+        else:
+            store[key] = 1
+            if len(store) > self.max_bins:
+                self._collapse(store)
+        self.count += 1
+        self.sum += val
+        self.sum_squares += val * val
+        if self.min is None or val < self.min:
+            self.min = val
+        if self.max is None or val > self.max:
+            self.max = val
+
+    # Allows a sketch to stand in for the plain list of timer values
+    append = update
+
+    def merge(self, other):
+        if other.gamma != self.gamma:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        if not other.count:
+            return
+        for store, ostore in ((self.positive, other.positive),
+                              (self.negative, other.negative)):
+            for key, cnt in ostore.items():
+                store[key] = store.get(key, 0) + cnt
+            if len(store) > self.max_bins:
+                self._collapse(store)
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        self.sum_squares += other.sum_squares
+        if self.min is None or other.min < self.min:
+            self.min = other.min
+        if self.max is None or other.max > self.max:
+            self.max = other.max
+
+    def buckets(self):
+        """Yield (value, count) pairs in ascending order of value"""
+        for key in sorted(self.negative, reverse=True):
+            yield self._clamp(-self._value(key)), self.negative[key]
+        if self.zero_count:
+            yield self._clamp(0.0), self.zero_count
+        for key in sorted(self.positive):
+            yield self._clamp(self._value(key)), self.positive[key]
+
+    def value_at_rank(self, rank):
+        """Approximate value of the rank'th (zero based) lowest value"""
+        if rank <= 0:
+            return self.min
+        if rank >= self.count - 1:
+            return self.max
+        seen = 0
+        for value, cnt in self.buckets():
+            seen += cnt
+            if seen > rank:
+                return value
+        return self.max
+
+    def quantile(self, q):
+        return self.value_at_rank(int(q * (self.count - 1)))
+
+    def head(self, n):
+        """Approximate (sum, sum_squares) of the n lowest values"""
+        if n >= self.count:
+            return self.sum, self.sum_squares
+        vsum = vsum_squares = 0.0
+        for value, cnt in self.buckets():
+            cnt = min(cnt, n)
+            vsum += value * cnt
+            vsum_squares += value * value * cnt
+            n -= cnt
+            if n <= 0:
+                break
+        return vsum, vsum_squares
+
+    def _key(self, val):
+        return int(math.ceil(math.log(val) / self.log_gamma))
+
+    def _value(self, key):
+        return 2.0 * self.gamma ** key / (self.gamma + 1)
+
+    def _clamp(self, value):
+        return min(max(value, self.min), self.max)
+
+    def _collapse(self, store):
+        keys = sorted(store)
+        excess = len(keys) - self.max_bins
+        target = keys[excess]
+        for key in keys[:excess]:
+            store[target] += store.pop(key)
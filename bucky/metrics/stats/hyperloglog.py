@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import math
+import struct
+import hashlib
+import collections
+
+
+class HyperLogLog(object):
+    """
+    A mergeable cardinality estimator. Based on the HyperLogLog algorithm
+    by Flajolet, Fusy, Gandouet and Meunier:
+
+      http://algo.inria.fr/flajolet/Publications/FlFuGaMe07.pdf
+
+    Uses 2 ** precision one byte registers, the standard error of the
+    estimate is about 1.04 / sqrt(2 ** precision). Members are hashed
+    with SHA-1 so sketches built in different processes or hosts can be
+    merged, sketches can only be merged when their precision matches.
+    """
+
+    hash_struct = struct.Struct(">Q")
+
+    def __init__(self, precision=14):
+        if not 4 <= precision <= 16:
+            raise ValueError("Precision must be between 4 and 16")
+        self.precision = precision
+        self.m = 1 << precision
+        self.registers = bytearray(self.m)
+        if self.m >= 128:
+            self.alpha = 0.7213 / (1 + 1.079 / self.m)
+        else:
+            self.alpha = {16: 0.673, 32: 0.697, 64: 0.709}[self.m]
+
+    def __len__(self):
+        return int(round(self.cardinality()))
+
+    def add(self, member):
+        if not isinstance(member, bytes):
+            member = member.encode("utf-8")
+        x = self.hash_struct.unpack_from(hashlib.sha1(member).digest())[0]
+        p = self.precision
+        idx = x >> (64 - p)
+        w = (x << p) & 0xFFFFFFFFFFFFFFFF
+        rho = 65 - w.bit_length() if w else 65 - p
+        if rho > self.registers[idx]:
+            self.registers[idx] = rho
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge sketches with different precision")
+        self.registers = bytearray(map(max, self.registers, other.registers))
+
+    def cardinality(self):
+        m = self.m
+        histogram = collections.Counter(self.registers)
+        estimate = self.alpha * m * m / sum(cnt * 2.0 ** -rho for rho, cnt in histogram.items())
+        zeros = histogram.get(0, 0)
+        if zeros and estimate <= 2.5 * m:
+            # Linear counting is more accurate for small cardinalities
+            estimate = m * math.log(m / float(zeros))
+        return estimate
@@ -40,6 +40,7 @@ from bucky.metrics.histogram import Histogram
 from bucky.metrics.meter import Meter
 from bucky.metrics.timer import Timer
 from bucky.udpserver import UDPServer
+from bucky.helpers import LRUCache, jump_hash, stable_hash
 
 
 log = logging.getLogger(__name__)
@@ -193,10 +194,27 @@ class MetricsDHandler(multiprocessing.Process):
 
 
 class MetricsDServer(UDPServer):
+    """
+    Every interval class of metricsd_handlers is served by
+    metricsd_handler_shards MetricsDHandler processes, a metric goes to
+    one of them by a stable hash of its name. The handler of a name is
+    kept in an LRU cache of metricsd_route_cache_size entries, the
+    patterns are only matched for names not in it.
+    """
+
     def __init__(self, queue, cfg):
-        super(MetricsDServer, self).__init__(cfg.metricsd_ip, cfg.metricsd_port)
+        super(MetricsDServer, self).__init__(cfg.metricsd_ip, cfg.metricsd_port,
+                                             recv_buffer=cfg.metricsd_recv_buffer)
+        self.queue = queue
         self.parser = MetricsDParser()
+        if cfg.metricsd_handler_shards < 1:
+            raise ConfigError("Invalid number of handler shards: %s" % cfg.metricsd_handler_shards)
+        self.shards = cfg.metricsd_handler_shards
         self.handlers = self._init_handlers(queue, cfg)
+        if cfg.metricsd_route_cache_size:
+            self.route_cache = LRUCache(cfg.metricsd_route_cache_size)
+        else:
+            self.route_cache = None
 
     def handle(self, data, addr):
         try:
@@ -210,10 +228,6 @@ class MetricsDServer(UDPServer):
         ret = []
         default = cfg.metricsd_default_interval
         handlers = cfg.metricsd_handlers
-        if not len(handlers):
-            ret = [(None, MetricsDHandler(queue, default))]
-            ret[0][1].start()
-            return ret
         for item in handlers:
             if len(item) == 2:
                 pattern, interval, priority = item[0], item[1], 100
@@ -228,22 +242,39 @@ class MetricsDServer(UDPServer):
             if interval < 0:
                 raise ConfigError("Invalid interval: %s" % interval)
             ret.append((pattern, interval, priority))
-        handlers.sort(key=lambda p: p[2])
-        ret = [(p, MetricsDHandler(queue, i)) for (p, i, _) in ret]
-        ret.append((None, MetricsDHandler(queue, default)))
-        for _, h in ret:
-            h.start()
+        # The largest priority wins
+        ret.sort(key=lambda p: p[2], reverse=True)
+        ret = [(p, self._start_shards(queue, i)) for (p, i, _) in ret]
+        ret.append((None, self._start_shards(queue, default)))
         return ret
 
+    def _start_shards(self, queue, interval):
+        shards = [MetricsDHandler(queue, interval) for i in range(self.shards)]
+        for h in shards:
+            h.start()
+        return shards
+
     def _get_handler(self, name):
-        for (p, h) in self.handlers:
-            if p is None:
-                return h
-            if p.match(name):
-                return h
+        route_cache = self.route_cache
+        if route_cache is not None:
+            handler = route_cache.get(name)
+            if handler is not None:
+                return handler
+        for (p, shards) in self.handlers:
+            if p is None or p.match(name):
+                break
+        if len(shards) > 1:
+            handler = shards[jump_hash(stable_hash(name), len(shards))]
+        else:
+            handler = shards[0]
+        if route_cache is not None:
+            route_cache.set(name, handler)
+        return handler
 
     def close(self):
-        for pattern, handler in self.handlers:
-            handler.close()
-            handler.join(cfg.process_join_timeout)
+        for pattern, shards in self.handlers:
+            for handler in shards:
+                handler.close()
+            for handler in shards:
+                handler.join(cfg.process_join_timeout)
         super(MetricsDServer, self).close()
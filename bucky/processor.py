@@ -1,6 +1,8 @@
 import logging
 import multiprocessing
 
+from bucky.frames import SampleFrame
+
 try:
     from setproctitle import setproctitle
 except ImportError:
@@ -34,15 +36,37 @@ class Processor(multiprocessing.Process):
             except queue.Empty:
                 pass
             else:
-                try:
-                    sample = self.process(*sample)
-                except Exception as exc:
-                    log.error("Error processing sample %s: %r", sample, exc)
-                    if self.drop_on_error:
-                        sample = None
+                if isinstance(sample, SampleFrame):
+                    self.process_frame(sample)
+                    continue
+                sample = self.process_sample(sample)
                 if sample is not None:
                     self.out_queue.put(sample)
 
+    def process_sample(self, sample):
+        try:
+            sample = self.process(*sample)
+        except Exception as exc:
+            log.error("Error processing sample %s: %r", sample, exc)
+            if self.drop_on_error:
+                sample = None
+        return sample
+
+    def process_frame(self, frame):
+        # Samples keeping the host and time of the frame are forwarded in a
+        # new frame, samples the processor moved elsewhere are sent alone.
+        out = SampleFrame(frame.host, frame.time, frame.metadata)
+        for sample in frame:
+            sample = self.process_sample(sample)
+            if sample is None:
+                continue
+            if sample[0] == out.host and sample[3] == out.time:
+                out.add(sample[1], sample[2], sample[4] if len(sample) > 4 else None)
+            else:
+                self.out_queue.put(sample)
+        if out:
+            self.out_queue.put(out)
+
     def process(self, host, name, val, time):
         raise NotImplementedError()
 
@@ -20,9 +20,29 @@ import six
 import math
 import time
 import json
+import array
+import signal
+import socket
 import logging
 import threading
+import multiprocessing
 import bucky.udpserver as udpserver
+from bucky.errors import ConfigError
+from bucky.frames import SampleFrame
+from bucky.helpers import LRUCache
+from bucky.metrics.stats.ddsketch import DDSketch
+from bucky.metrics.stats.hyperloglog import HyperLogLog
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    from setproctitle import setproctitle
+except ImportError:
+    def setproctitle(title):
+        pass
 
 log = logging.getLogger(__name__)
 
@@ -46,17 +66,39 @@ if six.PY3:
         with open(gauges_filename, mode='r', encoding='utf-8') as f:
             return json.load(f)
 
-    def write_json_file(gauges_filename, gauges):
+    def write_json_file(gauges_filename, gauges, sync=False):
         with open(gauges_filename, mode='w', encoding='utf-8') as f:
             json.dump(gauges, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
 else:
     def read_json_file(gauges_filename):
         with open(gauges_filename, mode='rb') as f:
             return json.load(f)
 
-    def write_json_file(gauges_filename, gauges):
+    def write_json_file(gauges_filename, gauges, sync=False):
         with open(gauges_filename, mode='wb') as f:
             json.dump(gauges, f)
+            if sync:
+                f.flush()
+                os.fsync(f.fileno())
+
+
+if six.PY3:
+    def _str(data):
+        return data.decode()
+else:
+    def _str(data):
+        return data
+
+
+def timer_value(valstr):
+    """Parse a timer value, inf and nan can not be aggregated"""
+    val = float(valstr or 0)
+    if math.isinf(val) or math.isnan(val):
+        raise ValueError("Non finite timer value: %r" % valstr)
+    return val
 
 
 def make_name(parts):
@@ -67,6 +109,19 @@ def make_name(parts):
     return name
 
 
+class StatsDBatch(object):
+    """Stats parsed from one or more datagrams, applied to the handler at once"""
+
+    __slots__ = ("timers", "counters", "gauges", "sets", "keys_seen")
+
+    def __init__(self):
+        self.timers = []
+        self.counters = {}
+        self.gauges = []
+        self.sets = []
+        self.keys_seen = {}
+
+
 class StatsDHandler(threading.Thread):
     def __init__(self, queue, cfg):
         super(StatsDHandler, self).__init__()
@@ -86,11 +141,22 @@ class StatsDHandler(threading.Thread):
         self.prefix_gauge = cfg.statsd_prefix_gauge
         self.prefix_set = cfg.statsd_prefix_set
         self.metadata = cfg.statsd_metadata
+        self.flush_frames = cfg.statsd_flush_frames
+        self.frame_size = cfg.statsd_frame_size
+        self.frame = None
         self.key_res = (
             (re.compile("\s+"), "_"),
             (re.compile("\/"), "-"),
             (re.compile("[^a-zA-Z_\-0-9\.]"), "")
         )
+        self.raw_key_res = tuple((re.compile(rexp.pattern.encode()), repl.encode())
+                                 for rexp, repl in self.key_res)
+        # Most keys need no sanitizing, a single search is enough for them
+        self.raw_key_dirty = re.compile(b"[^a-zA-Z_\\-0-9\\.]").search
+        if cfg.statsd_key_cache_size:
+            self.key_cache = LRUCache(cfg.statsd_key_cache_size)
+        else:
+            self.key_cache = None
 
         if self.legacy_namespace:
             self.name_global = 'stats.'
@@ -108,10 +174,22 @@ class StatsDHandler(threading.Thread):
 
         self.statsd_persistent_gauges = cfg.statsd_persistent_gauges
         self.gauges_filename = os.path.join(self.cfg.directory, self.cfg.statsd_gauges_savefile)
+        self.gauges_journal = self.statsd_persistent_gauges and cfg.statsd_gauges_journal
+        self.journal_filename = self.gauges_filename + ".journal"
+        self.journal_compact_interval = cfg.statsd_gauges_journal_compact_interval
+        self.journal_lock = threading.Lock()
+        self.journal = None
+        self.last_compaction = time.time()
 
         self.pct_thresholds = cfg.statsd_percentile_thresholds
 
         self.keys_seen = {}
+        self.key_metadata = {}
+        # Gauge updates of the interval, only tracked by StatsDWorker
+        self.gauge_updates = None
+        self.timer_keys = set()
+        self.counter_keys = set()
+        self.set_keys = set()
         self.delete_idlestats = cfg.statsd_delete_idlestats
         self.delete_counters = self.delete_idlestats and cfg.statsd_delete_counters
         self.delete_timers = self.delete_idlestats and cfg.statsd_delete_timers
@@ -128,57 +206,171 @@ class StatsDHandler(threading.Thread):
         self.enable_timer_median = cfg.statsd_timer_median
         self.enable_timer_std = cfg.statsd_timer_std
 
+        self.timer_sketch = cfg.statsd_timer_sketch
+        self.sketch_accuracy = cfg.statsd_timer_sketch_accuracy
+        self.sketch_max_bins = cfg.statsd_timer_sketch_max_bins
+        self.timer_numpy = cfg.statsd_timer_numpy
+        if self.timer_sketch and self.timer_numpy:
+            raise ConfigError("statsd_timer_sketch and statsd_timer_numpy "
+                              "can not be enabled at the same time")
+        if self.timer_numpy and numpy is None:
+            raise ConfigError("statsd_timer_numpy requires numpy to be installed")
+        if self.timer_sketch:
+            self.timer_stats = self.timer_stats_sketch
+        elif self.timer_numpy:
+            self.timer_stats = self.timer_stats_numpy
+        else:
+            self.timer_stats = self.timer_stats_values
+
+        self.set_hyperloglog = cfg.statsd_set_hyperloglog
+        self.set_precision = cfg.statsd_set_hyperloglog_precision
+        if self.set_hyperloglog and not 4 <= self.set_precision <= 16:
+            raise ConfigError("statsd_set_hyperloglog_precision must be between 4 and 16")
+
     def load_gauges(self):
         if not self.statsd_persistent_gauges:
             return
-        if not os.path.isfile(self.gauges_filename):
-            return
-        log.info("StatsD: Loading saved gauges %s", self.gauges_filename)
-        try:
-            gauges = read_json_file(self.gauges_filename)
-        except IOError:
-            log.exception("StatsD: IOError")
-        else:
-            self.gauges.update({k: gauges[k][0] for k in gauges.keys()})
-            self.keys_seen.update({k: gauges[k][1] for k in gauges.keys()})
+        if os.path.isfile(self.gauges_filename):
+            log.info("StatsD: Loading saved gauges %s", self.gauges_filename)
+            try:
+                self.update_gauges(read_json_file(self.gauges_filename))
+            except IOError:
+                log.exception("StatsD: IOError")
+        if self.gauges_journal:
+            self.replay_journal()
+
+    def update_gauges(self, gauges):
+        self.gauges.update({k: gauges[k][0] for k in gauges.keys()})
+        self.keys_seen.update({k: gauges[k][1] for k in gauges.keys()})
 
     def save_gauges(self):
         if not self.statsd_persistent_gauges:
             return
+        if self.journal is not None:
+            # Only the changes since the last flush are missing from the journal
+            with self.lock:
+                gauges = self.gauges.copy()
+                keys_seen = self.keys_seen.copy()
+            self.journal_gauges(gauges, keys_seen, compact=False)
+            return
         try:
             gauges = {}
             for k in self.gauges.keys():
-                gauges[k] = (self.gauges[k], self.keys_seen.get(k, None))
+                gauges[k] = (self.gauges[k], self.keys_seen.get(k, self.key_metadata.get(k)))
             write_json_file(self.gauges_filename, gauges)
         except IOError:
             log.exception("StatsD: IOError")
 
+    def replay_journal(self):
+        if os.path.isfile(self.journal_filename):
+            log.info("StatsD: Replaying gauges journal %s", self.journal_filename)
+            try:
+                with open(self.journal_filename, mode='rb') as f:
+                    for line in f:
+                        try:
+                            self.update_gauges(json.loads(line.decode("utf-8")))
+                        except ValueError:
+                            # A crash can leave a partially written last entry
+                            log.warning("StatsD: Skipping corrupt gauges journal entry")
+            except IOError:
+                log.exception("StatsD: IOError")
+        try:
+            self.journal = open(self.journal_filename, mode='ab')
+        except IOError:
+            log.exception("StatsD: IOError")
+            return
+        # Start from a fresh snapshot and an empty journal
+        with self.journal_lock:
+            try:
+                self.compact_gauges(self.gauges, self.keys_seen)
+            except (IOError, OSError):
+                log.exception("StatsD: IOError, gauges are not journaled")
+                self.journal.close()
+                self.journal = None
+
+    def journal_gauges(self, gauges, keys_seen, compact=True):
+        """Append the gauges updated during an interval to the journal"""
+        changed = {}
+        for k, v in keys_seen.items():
+            if k in gauges:
+                changed[k] = (gauges[k], v)
+        with self.journal_lock:
+            try:
+                if changed:
+                    self.journal.write(json.dumps(changed).encode("utf-8") + b"\n")
+                    self.journal.flush()
+                    os.fsync(self.journal.fileno())
+                if compact and time.time() - self.last_compaction >= self.journal_compact_interval:
+                    self.compact_gauges(gauges, self.key_metadata)
+            except (IOError, OSError):
+                log.exception("StatsD: IOError")
+
+    def compact_gauges(self, gauges, metadata):
+        """Write all gauges to the snapshot file and truncate the journal"""
+        snapshot = {}
+        for k, v in gauges.items():
+            snapshot[k] = (v, metadata.get(k))
+        tmp_filename = self.gauges_filename + ".tmp"
+        # The snapshot must be on disk before the journal is truncated
+        write_json_file(tmp_filename, snapshot, sync=True)
+        os.rename(tmp_filename, self.gauges_filename)
+        self.journal.seek(0)
+        self.journal.truncate()
+        self.last_compaction = time.time()
+
     def tick(self):
-        name_global_numstats = self.name_global + "numStats"
+        # Swap in fresh aggregation maps so the receive loop is only blocked
+        # for the swap, the old generation is flushed outside of the lock.
         stime = int(time.time())
+        timers, counters, gauges, sets, keys_seen = self.swap()
+        self.flush(timers, counters, gauges, sets, keys_seen, stime)
+
+    def swap(self):
         with self.lock:
-            if self.delete_timers:
-                rem_keys = set(self.timers.keys()) - set(self.keys_seen.keys())
-                for k in rem_keys:
-                    del self.timers[k]
-            if self.delete_counters:
-                rem_keys = set(self.counters.keys()) - set(self.keys_seen.keys())
-                for k in rem_keys:
-                    del self.counters[k]
-            if self.delete_sets:
-                rem_keys = set(self.sets.keys()) - set(self.keys_seen.keys())
-                for k in rem_keys:
-                    del self.sets[k]
-            num_stats = self.enqueue_timers(stime)
-            kept_keys = set(self.timers.keys())
-            num_stats += self.enqueue_counters(stime)
-            kept_keys = kept_keys.union(set(self.counters.keys()))
-            num_stats += self.enqueue_gauges(stime)
-            kept_keys = kept_keys.union(set(self.gauges.keys()))
-            num_stats += self.enqueue_sets(stime)
-            kept_keys = kept_keys.union(set(self.sets.keys()))
-            self.enqueue(name_global_numstats, num_stats, stime)
-            self.keys_seen = {k: self.keys_seen[k] for k in kept_keys if k in self.keys_seen}
+            timers, self.timers = self.timers, {}
+            counters, self.counters = self.counters, {}
+            sets, self.sets = self.sets, {}
+            keys_seen, self.keys_seen = self.keys_seen, {}
+            if self.gauge_updates is None:
+                gauges = self.gauges.copy()
+            else:
+                # Only the gauges updated during the interval, see
+                # update_gauge for the fields.
+                gauges = dict((k, tuple(v)) for k, v in self.gauge_updates.items())
+                self.gauge_updates = {}
+        return timers, counters, gauges, sets, keys_seen
+
+    def flush(self, timers, counters, gauges, sets, keys_seen, stime):
+        name_global_numstats = self.name_global + "numStats"
+        self.key_metadata.update(keys_seen)
+        # Stats not seen during this interval are reported as idle
+        # unless they are configured to be deleted.
+        if not self.delete_timers:
+            self.timer_keys.update(timers)
+            for k in self.timer_keys.difference(timers):
+                timers[k] = []
+        if not self.delete_counters:
+            self.counter_keys.update(counters)
+            for k in self.counter_keys.difference(counters):
+                counters[k] = 0
+        if not self.delete_sets:
+            self.set_keys.update(sets)
+            for k in self.set_keys.difference(sets):
+                sets[k] = set()
+        if self.flush_frames:
+            self.frame = SampleFrame(None, stime, self.metadata)
+        num_stats = self.enqueue_timers(timers, stime)
+        num_stats += self.enqueue_counters(counters, stime)
+        num_stats += self.enqueue_gauges(gauges, keys_seen, stime)
+        if self.journal is not None:
+            self.journal_gauges(gauges, keys_seen)
+        num_stats += self.enqueue_sets(sets, stime)
+        self.enqueue(name_global_numstats, num_stats, stime)
+        if self.frame is not None:
+            self.flush_frame()
+            self.frame = None
+        kept_keys = set(timers).union(counters, gauges, sets)
+        self.key_metadata = {k: v for k, v in self.key_metadata.items() if k in kept_keys}
 
     def run(self):
         while True:
@@ -188,122 +380,224 @@ class StatsDHandler(threading.Thread):
     def enqueue(self, name, stat, stime, metadata_key=None):
         # No hostnames on statsd
         if metadata_key:
-            metadata = self.keys_seen.get(metadata_key, None)
+            metadata = self.key_metadata.get(metadata_key, None)
         else:
             metadata = self.metadata
-        if metadata:
+        if self.frame is not None:
+            self.frame.add(name, stat, metadata)
+            if self.frame_size and len(self.frame) >= self.frame_size:
+                self.flush_frame()
+        elif metadata:
             self.queue.put((None, name, stat, stime, metadata))
         else:
             self.queue.put((None, name, stat, stime))
 
-    def enqueue_timers(self, stime):
+    def flush_frame(self):
+        if self.frame:
+            self.queue.put(self.frame)
+            self.frame = SampleFrame(None, self.frame.time, self.metadata)
+
+    def new_timer(self):
+        if self.timer_sketch:
+            return DDSketch(self.sketch_accuracy, self.sketch_max_bins)
+        if self.timer_numpy:
+            return array.array('d')
+        return []
+
+    def new_set(self):
+        if self.set_hyperloglog:
+            return HyperLogLog(self.set_precision)
+        return set()
+
+    def enqueue_timers(self, timers, stime):
         ret = 0
-        iteritems = self.timers.items() if six.PY3 else self.timers.iteritems()
+        iteritems = timers.items() if six.PY3 else timers.iteritems()
         for k, v in iteritems:
             # Skip timers that haven't collected any values
             if not v:
                 self.enqueue("%s%s.count" % (self.name_timer, k), 0, stime, k)
                 self.enqueue("%s%s.count_ps" % (self.name_timer, k), 0.0, stime, k)
             else:
-                v.sort()
-                count = len(v)
-                vmin, vmax = v[0], v[-1]
-
-                cumulative_values = [vmin]
-                cumul_sum_squares_values = [vmin * vmin]
-                for i, value in enumerate(v):
-                    if i == 0:
-                        continue
-                    cumulative_values.append(value + cumulative_values[i - 1])
-                    cumul_sum_squares_values.append(
-                        value * value + cumul_sum_squares_values[i - 1])
-
-                for pct_thresh in self.pct_thresholds:
-                    thresh_idx = int(math.floor(pct_thresh / 100.0 * count))
-                    if thresh_idx == 0:
-                        continue
-                    vsum = cumulative_values[thresh_idx - 1]
-
-                    t = int(pct_thresh)
-                    if self.enable_timer_mean:
-                        mean = vsum / float(thresh_idx)
-                        self.enqueue("%s%s.mean_%s" % (self.name_timer, k, t), mean, stime, k)
-
-                    if self.enable_timer_upper:
-                        vthresh = v[thresh_idx - 1]
-                        self.enqueue("%s%s.upper_%s" % (self.name_timer, k, t), vthresh, stime, k)
-
-                    if self.enable_timer_count:
-                        self.enqueue("%s%s.count_%s" % (self.name_timer, k, t), thresh_idx, stime, k)
-
-                    if self.enable_timer_sum:
-                        self.enqueue("%s%s.sum_%s" % (self.name_timer, k, t), vsum, stime, k)
-
-                    if self.enable_timer_sum_squares:
-                        vsum_squares = cumul_sum_squares_values[thresh_idx - 1]
-                        self.enqueue("%s%s.sum_squares_%s" % (self.name_timer, k, t), vsum_squares, stime, k)
-
-                vsum = cumulative_values[count - 1]
-                mean = vsum / float(count)
-
-                if self.enable_timer_mean:
-                    self.enqueue("%s%s.mean" % (self.name_timer, k), mean, stime, k)
-
-                if self.enable_timer_upper:
-                    self.enqueue("%s%s.upper" % (self.name_timer, k), vmax, stime, k)
-
-                if self.enable_timer_lower:
-                    self.enqueue("%s%s.lower" % (self.name_timer, k), vmin, stime, k)
-
-                if self.enable_timer_count:
-                    self.enqueue("%s%s.count" % (self.name_timer, k), count, stime, k)
-
-                if self.enable_timer_count_ps:
-                    self.enqueue("%s%s.count_ps" % (self.name_timer, k), float(count) / self.flush_time, stime, k)
-
-                if self.enable_timer_median:
-                    mid = int(count / 2)
-                    median = (v[mid - 1] + v[mid]) / 2.0 if count % 2 == 0 else v[mid]
-                    self.enqueue("%s%s.median" % (self.name_timer, k), median, stime, k)
-
-                if self.enable_timer_sum:
-                    self.enqueue("%s%s.sum" % (self.name_timer, k), vsum, stime, k)
-
-                if self.enable_timer_sum_squares:
-                    vsum_squares = cumul_sum_squares_values[count - 1]
-                    self.enqueue("%s%s.sum_squares" % (self.name_timer, k), vsum_squares, stime, k)
-
-                if self.enable_timer_std:
-                    sum_of_diffs = sum(((value - mean) ** 2 for value in v))
-                    stddev = math.sqrt(sum_of_diffs / count)
-                    self.enqueue("%s%s.std" % (self.name_timer, k), stddev, stime, k)
-            self.timers[k] = []
+                pct_stats, stats = self.timer_stats(v)
+                self.enqueue_timer(k, pct_stats, stats, stime)
             ret += 1
 
         return ret
 
-    def enqueue_sets(self, stime):
+    def enqueue_timer(self, k, pct_stats, stats, stime):
+        for t, thresh_idx, vsum, vthresh, vsum_squares in pct_stats:
+            if self.enable_timer_mean:
+                mean = vsum / float(thresh_idx)
+                self.enqueue("%s%s.mean_%s" % (self.name_timer, k, t), mean, stime, k)
+
+            if self.enable_timer_upper:
+                self.enqueue("%s%s.upper_%s" % (self.name_timer, k, t), vthresh, stime, k)
+
+            if self.enable_timer_count:
+                self.enqueue("%s%s.count_%s" % (self.name_timer, k, t), thresh_idx, stime, k)
+
+            if self.enable_timer_sum:
+                self.enqueue("%s%s.sum_%s" % (self.name_timer, k, t), vsum, stime, k)
+
+            if self.enable_timer_sum_squares:
+                self.enqueue("%s%s.sum_squares_%s" % (self.name_timer, k, t), vsum_squares, stime, k)
+
+        count, vmin, vmax, vsum, vsum_squares, median, stddev = stats
+        mean = vsum / float(count)
+
+        if self.enable_timer_mean:
+            self.enqueue("%s%s.mean" % (self.name_timer, k), mean, stime, k)
+
+        if self.enable_timer_upper:
+            self.enqueue("%s%s.upper" % (self.name_timer, k), vmax, stime, k)
+
+        if self.enable_timer_lower:
+            self.enqueue("%s%s.lower" % (self.name_timer, k), vmin, stime, k)
+
+        if self.enable_timer_count:
+            self.enqueue("%s%s.count" % (self.name_timer, k), count, stime, k)
+
+        if self.enable_timer_count_ps:
+            self.enqueue("%s%s.count_ps" % (self.name_timer, k), float(count) / self.flush_time, stime, k)
+
+        if self.enable_timer_median:
+            self.enqueue("%s%s.median" % (self.name_timer, k), median, stime, k)
+
+        if self.enable_timer_sum:
+            self.enqueue("%s%s.sum" % (self.name_timer, k), vsum, stime, k)
+
+        if self.enable_timer_sum_squares:
+            self.enqueue("%s%s.sum_squares" % (self.name_timer, k), vsum_squares, stime, k)
+
+        if self.enable_timer_std:
+            self.enqueue("%s%s.std" % (self.name_timer, k), stddev, stime, k)
+
+    def timer_stats_values(self, v):
+        v.sort()
+        count = len(v)
+        vmin, vmax = v[0], v[-1]
+
+        cumulative_values = [vmin]
+        cumul_sum_squares_values = [vmin * vmin]
+        for i, value in enumerate(v):
+            if i == 0:
+                continue
+            cumulative_values.append(value + cumulative_values[i - 1])
+            cumul_sum_squares_values.append(
+                value * value + cumul_sum_squares_values[i - 1])
+
+        pct_stats = []
+        for pct_thresh in self.pct_thresholds:
+            thresh_idx = int(math.floor(pct_thresh / 100.0 * count))
+            if thresh_idx == 0:
+                continue
+            pct_stats.append((
+                int(pct_thresh),
+                thresh_idx,
+                cumulative_values[thresh_idx - 1],
+                v[thresh_idx - 1],
+                cumul_sum_squares_values[thresh_idx - 1],
+            ))
+
+        vsum = cumulative_values[count - 1]
+        mid = int(count / 2)
+        median = (v[mid - 1] + v[mid]) / 2.0 if count % 2 == 0 else v[mid]
+        stddev = None
+        if self.enable_timer_std:
+            mean = vsum / float(count)
+            # Added up one at a time like numpy.cumsum, sum() of floats
+            # compensates the rounding since Python 3.12. Squaring by
+            # multiplication is exactly rounded, unlike pow() from libm.
+            sum_of_diffs = 0.0
+            for value in v:
+                diff = value - mean
+                sum_of_diffs += diff * diff
+            stddev = math.sqrt(sum_of_diffs / count)
+        stats = (count, vmin, vmax, vsum, cumul_sum_squares_values[count - 1], median, stddev)
+        return pct_stats, stats
+
+    def timer_stats_numpy(self, v):
+        # Same computation as timer_stats_values, numpy.cumsum adds up
+        # sequentially so the results are identical.
+        v = numpy.sort(numpy.frombuffer(v, dtype=numpy.float64))
+        count = len(v)
+        cumulative_values = numpy.cumsum(v)
+        cumul_sum_squares_values = numpy.cumsum(v * v)
+
+        pct_stats = []
+        for pct_thresh in self.pct_thresholds:
+            thresh_idx = int(math.floor(pct_thresh / 100.0 * count))
+            if thresh_idx == 0:
+                continue
+            pct_stats.append((
+                int(pct_thresh),
+                thresh_idx,
+                float(cumulative_values[thresh_idx - 1]),
+                float(v[thresh_idx - 1]),
+                float(cumul_sum_squares_values[thresh_idx - 1]),
+            ))
+
+        vsum = float(cumulative_values[-1])
+        mid = int(count / 2)
+        median = float((v[mid - 1] + v[mid]) / 2.0 if count % 2 == 0 else v[mid])
+        stddev = None
+        if self.enable_timer_std:
+            diffs = v - vsum / float(count)
+            stddev = math.sqrt(float(numpy.cumsum(diffs * diffs)[-1]) / count)
+        stats = (count, float(v[0]), float(v[-1]), vsum,
+                 float(cumul_sum_squares_values[-1]), median, stddev)
+        return pct_stats, stats
+
+    def timer_stats_sketch(self, v):
+        # Percentile sums and values are approximated from the sketch
+        # buckets, totals, lower and upper bounds are exact.
+        count = len(v)
+
+        pct_stats = []
+        for pct_thresh in self.pct_thresholds:
+            thresh_idx = int(math.floor(pct_thresh / 100.0 * count))
+            if thresh_idx == 0:
+                continue
+            vsum, vsum_squares = v.head(thresh_idx)
+            pct_stats.append((
+                int(pct_thresh),
+                thresh_idx,
+                vsum,
+                v.value_at_rank(thresh_idx - 1),
+                vsum_squares,
+            ))
+
+        mid = int(count / 2)
+        if count % 2 == 0:
+            median = (v.value_at_rank(mid - 1) + v.value_at_rank(mid)) / 2.0
+        else:
+            median = v.value_at_rank(mid)
+        mean = v.sum / float(count)
+        stddev = math.sqrt(max(v.sum_squares / count - mean * mean, 0.0))
+        stats = (count, v.min, v.max, v.sum, v.sum_squares, median, stddev)
+        return pct_stats, stats
+
+    def enqueue_sets(self, sets, stime):
         ret = 0
-        iteritems = self.sets.items() if six.PY3 else self.sets.iteritems()
+        iteritems = sets.items() if six.PY3 else sets.iteritems()
         for k, v in iteritems:
             self.enqueue("%s%s.count" % (self.name_set, k), len(v), stime, k)
             ret += 1
-            self.sets[k] = set()
         return ret
 
-    def enqueue_gauges(self, stime):
+    def enqueue_gauges(self, gauges, keys_seen, stime):
         ret = 0
-        iteritems = self.gauges.items() if six.PY3 else self.gauges.iteritems()
+        iteritems = gauges.items() if six.PY3 else gauges.iteritems()
         for k, v in iteritems:
             # only send a value if there was an update if `delete_idlestats` is `True`
-            if not self.onlychanged_gauges or k in self.keys_seen:
+            if not self.onlychanged_gauges or k in keys_seen:
                 self.enqueue("%s%s" % (self.name_gauge, k), v, stime, k)
                 ret += 1
         return ret
 
-    def enqueue_counters(self, stime):
+    def enqueue_counters(self, counters, stime):
         ret = 0
-        iteritems = self.counters.items() if six.PY3 else self.counters.iteritems()
+        iteritems = counters.items() if six.PY3 else counters.iteritems()
         for k, v in iteritems:
             if self.legacy_namespace:
                 stat_rate = "%s%s" % (self.name_legacy_rate, k)
@@ -313,7 +607,6 @@ class StatsDHandler(threading.Thread):
                 stat_count = "%s%s.count" % (self.name_counter, k)
             self.enqueue(stat_rate, v / self.flush_time, stime, k)
             self.enqueue(stat_count, v, stime, k)
-            self.counters[k] = 0
             ret += 1
         return ret
 
@@ -321,19 +614,128 @@ class StatsDHandler(threading.Thread):
         # Adding a bit of extra sauce so clients can
         # send multiple samples in a single UDP
         # packet.
+        batch = StatsDBatch()
+        self.parse(data, batch)
+        self.apply(batch)
+
+    def handle_batch(self, datagrams):
+        batch = StatsDBatch()
+        for data in datagrams:
+            self.parse(data, batch)
+        self.apply(batch)
+
+    def parse(self, data, batch):
+        """Parse the lines of a raw datagram into batch"""
+        timers = batch.timers
+        counters = batch.counters
+        gauges = batch.gauges
+        sets = batch.sets
+        keys_seen = batch.keys_seen
+        metadata = self.metadata
+        sanitize_key = self.sanitize_key
         for line in data.splitlines():
-            self.line = line
             if not line.strip():
                 continue
-            self.handle_line(line)
+            self.line = line
+            tags = metadata
+            if b"#" in line:
+                bits = line.split(b"#")
+                line, tags = bits[0], self.parse_tags(_str(bits[1]))
+                if metadata:
+                    tags.update(metadata)
+            bits = line.split(b":")
+            key = sanitize_key(bits[0])
+            keys_seen[key] = tags
+
+            if len(bits) < 2:
+                self.bad_line()
+                continue
+
+            for sample in bits[1:]:
+                fields = sample.split(b"|")
+                if len(fields) < 2:
+                    self.bad_line()
+                    continue
+                mtype = fields[1]
+                try:
+                    if mtype == b"ms":
+                        timers.append((key, timer_value(fields[0])))
+                    elif mtype == b"g":
+                        valstr = fields[0] or b"0"
+                        delta = valstr[:1] in (b"+", b"-")
+                        gauges.append((key, float(valstr), delta))
+                    elif mtype == b"s":
+                        sets.append((key, _str(fields[0] or b"0")))
+                    else:
+                        rate = 1.0
+                        if len(fields) > 2 and fields[2][:1] == b"@":
+                            try:
+                                rate = float(fields[2][1:].strip())
+                            except ValueError:
+                                rate = 1.0
+                        val = int(float(fields[0] or 0) / rate)
+                        counters[key] = counters.get(key, 0) + val
+                except Exception:
+                    self.bad_line()
+
+    def apply(self, batch):
+        """Add the parsed stats of batch holding the lock only once"""
+        with self.lock:
+            timers = self.timers
+            for key, val in batch.timers:
+                timer = timers.get(key)
+                if timer is None:
+                    timer = timers[key] = self.new_timer()
+                timer.append(val)
+            counters = self.counters
+            for key, val in batch.counters.items():
+                counters[key] = counters.get(key, 0) + val
+            if self.gauge_updates is None:
+                gauges = self.gauges
+                for key, val, delta in batch.gauges:
+                    if delta and key in gauges:
+                        gauges[key] = gauges[key] + val
+                    else:
+                        gauges[key] = val
+            elif batch.gauges:
+                now = time.time()
+                for key, val, delta in batch.gauges:
+                    self.update_gauge(key, val, delta, now)
+            sets = self.sets
+            for key, val in batch.sets:
+                members = sets.get(key)
+                if members is None:
+                    members = sets[key] = self.new_set()
+                members.add(val)
+            self.keys_seen.update(batch.keys_seen)
+
+    def sanitize_key(self, key):
+        cache = self.key_cache
+        if cache is not None:
+            skey = cache.get(key)
+            if skey is not None:
+                return skey
+        if self.raw_key_dirty(key) is None:
+            skey = _str(key)
+        else:
+            skey = key
+            for (rexp, repl) in self.raw_key_res:
+                skey = rexp.sub(repl, skey)
+            skey = _str(skey)
+        if cache is not None:
+            cache.set(key, skey)
+        return skey
 
     def handle_tags(self, line):
         # http://docs.datadoghq.com/guides/dogstatsd/#datagram-format
         bits = line.split("#")
         if len(bits) < 2:
             return line, None
+        return bits[0], self.parse_tags(bits[1])
+
+    def parse_tags(self, tagstr):
         tags = {}
-        for i in bits[1].split(","):
+        for i in tagstr.split(","):
             kv = i.split("=")
             if len(kv) > 1:
                 tags[kv[0]] = kv[1]
@@ -343,7 +745,7 @@ class StatsDHandler(threading.Thread):
                     tags[kv[0]] = kv[1]
                 else:
                     tags[kv[0]] = None
-        return bits[0], tags
+        return tags
 
     def handle_line(self, line):
         line, tags = self.handle_tags(line)
@@ -379,16 +781,25 @@ class StatsDHandler(threading.Thread):
             coalesced_tags = tags
             if self.metadata:
                 coalesced_tags.update(self.metadata)
-        for (rexp, repl) in self.key_res:
-            key = rexp.sub(repl, key)
-        self.keys_seen[key] = coalesced_tags
-        return key
+        cache = self.key_cache
+        skey = cache.get(key) if cache is not None else None
+        if skey is None:
+            skey = key
+            for (rexp, repl) in self.key_res:
+                skey = rexp.sub(repl, skey)
+            if cache is not None:
+                cache.set(key, skey)
+        self.keys_seen[skey] = coalesced_tags
+        return skey
 
     def handle_timer(self, key, fields):
         try:
-            val = float(fields[0] or 0)
+            val = timer_value(fields[0])
             with self.lock:
-                self.timers.setdefault(key, []).append(val)
+                timer = self.timers.get(key)
+                if timer is None:
+                    timer = self.timers[key] = self.new_timer()
+                timer.append(val)
         except Exception:
             self.bad_line()
 
@@ -401,16 +812,39 @@ class StatsDHandler(threading.Thread):
             return
         delta = valstr[0] in ["+", "-"]
         with self.lock:
-            if delta and key in self.gauges:
+            if self.gauge_updates is not None:
+                self.update_gauge(key, val, delta, time.time())
+            elif delta and key in self.gauges:
                 self.gauges[key] = self.gauges[key] + val
             else:
                 self.gauges[key] = val
 
+    def update_gauge(self, key, val, delta, now):
+        """Record a gauge update received by a StatsDWorker
+
+        The worker does not know the current value of the gauge, so it
+        keeps [value, value time, delta, delta time, receive time]: the
+        last absolute value (None if there was none), the sum of the
+        relative updates received after it, the time of the first of them
+        and the time of the last update. StatsDServerMP.merge applies them.
+
+        """
+        update = self.gauge_updates.get(key)
+        if not delta:
+            self.gauge_updates[key] = [val, now, 0, None, now]
+        elif update is None:
+            self.gauge_updates[key] = [None, now, val, now, now]
+        else:
+            if update[3] is None:
+                update[3] = now
+            update[2] += val
+            update[4] = now
+
     def handle_set(self, key, fields):
         valstr = fields[0] or "0"
         with self.lock:
             if key not in self.sets:
-                self.sets[key] = set()
+                self.sets[key] = self.new_set()
             self.sets[key].add(valstr)
 
     def handle_counter(self, key, fields):
@@ -431,12 +865,17 @@ class StatsDHandler(threading.Thread):
             self.counters[key] += val
 
     def bad_line(self):
-        log.error("StatsD: Invalid line: '%s'", self.line.strip())
+        line = self.line
+        if six.PY3 and isinstance(line, bytes):
+            line = line.decode(errors="replace")
+        log.error("StatsD: Invalid line: '%s'", line.strip())
 
 
 class StatsDServer(udpserver.UDPServer):
     def __init__(self, queue, cfg):
-        super(StatsDServer, self).__init__(cfg.statsd_ip, cfg.statsd_port)
+        super(StatsDServer, self).__init__(cfg.statsd_ip, cfg.statsd_port,
+                                           recv_buffer=cfg.statsd_recv_buffer)
+        self.queue = queue
         self.handler = StatsDHandler(queue, cfg)
 
     def pre_shutdown(self):
@@ -447,15 +886,197 @@ class StatsDServer(udpserver.UDPServer):
         self.handler.start()
         super(StatsDServer, self).run()
 
-    if six.PY3:
-        def handle(self, data, addr):
-            self.handler.handle(data.decode())
-            if not self.handler.is_alive():
+    def handle(self, data, addr):
+        self.handler.handle(data)
+        if not self.handler.is_alive():
+            return False
+        return True
+
+    def handle_batch(self, batch):
+        self.handler.handle_batch([data for data, addr in batch])
+        if not self.handler.is_alive():
+            return False
+        return True
+
+
+class StatsDWorker(udpserver.UDPServer):
+    """
+    StatsDWorker receives and aggregates a shard of the StatsD traffic.
+
+    All workers bind the StatsD port with SO_REUSEPORT. The aggregated
+    stats are not flushed by the worker, each generation is sent back over
+    the pipe when StatsDServerMP asks for it.
+    """
+
+    def __init__(self, pipe, queue, cfg, id_num=-1):
+        super(StatsDWorker, self).__init__(cfg.statsd_ip, cfg.statsd_port, reuseport=True,
+                                           recv_buffer=cfg.statsd_recv_buffer)
+        self.name = "StatsDWorker%d" % id_num
+        self.drops_name = "bucky.%s.udp_drops" % self.name
+        self.pipe = pipe
+        # Only used to publish the drop count of the socket
+        self.queue = queue
+        self.handler = StatsDHandler(None, cfg)
+        self.handler.gauge_updates = {}
+
+    def run(self):
+        # Workers are stopped with terminate() by StatsDServerMP
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        flusher = threading.Thread(target=self.serve_generations)
+        flusher.daemon = True
+        flusher.start()
+        super(StatsDWorker, self).run()
+
+    def serve_generations(self):
+        while True:
+            try:
+                self.pipe.recv()
+            except (EOFError, IOError):
+                break
+            self.pipe.send(self.handler.swap())
+
+    def handle(self, data, addr):
+        self.handler.handle(data)
+        return True
+
+    def handle_batch(self, batch):
+        self.handler.handle_batch([data for data, addr in batch])
+        return True
+
+
+class StatsDServerMP(multiprocessing.Process):
+    """Multiprocess StatsD server
+
+    Starts a configurable (cfg.statsd_workers) number of StatsDWorker
+    processes sharing the StatsD port. At every flush the generations of
+    all workers are merged per key, counters are summed, timers and sets
+    are combined and gauges take the most recently received value plus
+    the relative updates all workers received after it, and the merged
+    stats are flushed like a single StatsD server would. Relative updates
+    a worker received both before and after a newer value set through
+    another worker are dropped with the value they applied to.
+
+    """
+
+    def __init__(self, queue, cfg):
+        super(StatsDServerMP, self).__init__()
+        if not hasattr(socket, "SO_REUSEPORT"):
+            raise ConfigError("statsd_workers requires SO_REUSEPORT support")
+        self.daemon = False
+        self.queue = queue
+        self.cfg = cfg
+        self.ip = cfg.statsd_ip
+        self.port = cfg.statsd_port
+        self.handler = StatsDHandler(queue, cfg)
+        self.gauge_times = {}
+        self.stop = multiprocessing.Event()
+        self.workers = []
+
+    def run(self):
+        def sigterm_handler(signum, frame):
+            log.info("Received SIGTERM")
+            self.close()
+
+        setproctitle("bucky: %s" % self.__class__.__name__)
+        self.handler.load_gauges()
+        self.workers = []
+        for i in range(self.cfg.statsd_workers):
+            recv, send = multiprocessing.Pipe()
+            worker = StatsDWorker(recv, self.queue, self.cfg, i)
+            worker.start()
+            # The socket is only used by the worker itself
+            worker.sock.close()
+            self.workers.append((worker, send))
+
+        signal.signal(signal.SIGTERM, sigterm_handler)
+
+        while not self.stop.wait(self.handler.flush_time):
+            if not self.tick():
+                break
+        try:
+            self.pre_shutdown()
+        except Exception:
+            log.exception("Failed pre_shutdown method for %s",
+                          self.__class__.__name__)
+
+    def tick(self):
+        stime = int(time.time())
+        for worker, pipe in self.workers:
+            if not worker.is_alive():
+                log.error("Worker %s died, stopping server.", worker)
                 return False
-            return True
-    else:
-        def handle(self, data, addr):
-            self.handler.handle(data)
-            if not self.handler.is_alive():
+            pipe.send(True)
+        generations = []
+        for worker, pipe in self.workers:
+            if not pipe.poll(self.cfg.process_join_timeout):
+                log.error("Worker %s did not respond, stopping server.", worker)
                 return False
-            return True
+            generations.append(pipe.recv())
+        timers, counters, gauges, sets, keys_seen = self.merge(generations)
+        self.handler.flush(timers, counters, gauges, sets, keys_seen, stime)
+        return True
+
+    def merge(self, generations):
+        handler = self.handler
+        timers, counters, sets = {}, {}, {}
+        # Metadata of gauges loaded at startup
+        keys_seen, handler.keys_seen = handler.keys_seen, {}
+        gauge_keys_seen = {}
+        updates = {}
+        for g_timers, g_counters, g_gauges, g_sets, g_keys_seen in generations:
+            for k, v in g_timers.items():
+                timer = timers.get(k)
+                if timer is None:
+                    timers[k] = v
+                elif isinstance(timer, DDSketch):
+                    timer.merge(v)
+                else:
+                    timer.extend(v)
+            for k, v in g_counters.items():
+                counters[k] = counters.get(k, 0) + v
+            for k, update in g_gauges.items():
+                updates.setdefault(k, []).append((update, g_keys_seen.get(k)))
+            for k, v in g_sets.items():
+                members = sets.get(k)
+                if members is None:
+                    sets[k] = v
+                elif isinstance(members, HyperLogLog):
+                    members.merge(v)
+                else:
+                    members.update(v)
+            keys_seen.update(g_keys_seen)
+        for k, received in updates.items():
+            value, vtime = handler.gauges.get(k), self.gauge_times.get(k, 0)
+            for (v, v_time, delta, d_time, rtime), metadata in received:
+                if v is not None and v_time >= vtime:
+                    value, vtime = v, v_time
+            # Sum the relative updates of all workers received after the value
+            for (v, v_time, delta, d_time, rtime), metadata in received:
+                if d_time is not None and d_time >= vtime:
+                    value = (value or 0) + delta
+            handler.gauges[k] = value
+            self.gauge_times[k] = vtime
+            gauge_keys_seen[k] = max(received, key=lambda r: r[0][4])[1]
+        # The metadata of a gauge comes with its most recent update
+        keys_seen.update(gauge_keys_seen)
+        return timers, counters, handler.gauges.copy(), sets, keys_seen
+
+    def pre_shutdown(self):
+        log.info("Shutting down StatsDServer")
+        # Flush what the workers received since the last flush
+        self.tick()
+        self.handler.save_gauges()
+        for worker, pipe in self.workers:
+            log.info("Stopping worker %s", worker)
+            worker.terminate()
+        for worker, pipe in self.workers:
+            worker.join(self.cfg.process_join_timeout)
+
+    def close(self):
+        self.stop.set()
+
+
+def getStatsDServer(queue, cfg):
+    """Get the appropriate statsd server (multi processed or not)"""
+    server = StatsDServerMP if cfg.statsd_workers > 1 else StatsDServer
+    return server(queue, cfg)
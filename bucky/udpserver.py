@@ -12,8 +12,10 @@
 # License for the specific language governing permissions and limitations under
 # the License.
 
+import os
 import six
 import sys
+import time
 import socket
 import logging
 import multiprocessing
@@ -30,25 +32,46 @@ except ImportError:
 log = logging.getLogger(__name__)
 
 
+def socket_drops(sock):
+    """
+    Number of datagrams the kernel dropped for sock, read from
+    /proc/net/udp and /proc/net/udp6. Returns None where these are
+    not available.
+    """
+    try:
+        inode = str(os.fstat(sock.fileno()).st_ino)
+    except (OSError, IOError, socket.error):
+        return None
+    for path in ("/proc/net/udp", "/proc/net/udp6"):
+        try:
+            with open(path) as f:
+                next(f)  # header
+                for line in f:
+                    fields = line.split()
+                    if fields[9] == inode:
+                        return int(fields[-1])
+        except (IOError, StopIteration):
+            continue
+    return None
+
+
 class UDPServer(multiprocessing.Process):
-    def __init__(self, ip, port):
+    def __init__(self, ip, port, reuseport=False, recv_buffer=0, sock=None):
         super(UDPServer, self).__init__()
         self.daemon = True
-        addrinfo = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_DGRAM)
-        af, socktype, proto, canonname, addr = addrinfo[0]
-        ip, port = addr[:2]
-        self.ip = ip
-        self.port = port
-        self.sock = socket.socket(af, socket.SOCK_DGRAM)
-        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        try:
-            self.sock.bind((ip, port))
-            log.info("Bound socket socket %s:%s", ip, port)
-        except Exception:
-            log.exception("Error binding socket %s:%s.", ip, port)
-            sys.exit(1)
+        # Servers set this to their sample queue to publish drop counts
+        self.queue = None
+        self.drops_name = "bucky.%s.udp_drops" % self.__class__.__name__
+        self.drops_interval = cfg.udp_drops_interval
+        self.next_drops_check = time.time() + self.drops_interval
+        if sock is None:
+            sock = self.bind(ip, port, reuseport, recv_buffer)
+        # An already bound socket is taken over as is, e.g. by a restarted worker
+        self.sock = sock
+        self.ip, self.port = sock.getsockname()[:2]
 
         self.sock_recvfrom = self.sock.recvfrom
+        self.recv_batch = cfg.udp_recv_batch
         if cfg.debug:
             # When in debug mode replace the send and recvfrom functions to include
             # debug logging. In production mode these calls have quite a lot of overhead
@@ -64,29 +87,109 @@ class UDPServer(multiprocessing.Process):
             self.send = debugsend(self.send)
 
             def debugrecvfrom(*args, **kwargs):
-                data, addr = self.sock.recvfrom(65535)
+                data, addr = self.sock.recvfrom(*args, **kwargs)
                 log.debug("Received UDP packet from %s:%s" % addr)
                 return data, addr
             self.sock_recvfrom = debugrecvfrom
 
+    def bind(self, ip, port, reuseport=False, recv_buffer=0):
+        addrinfo = socket.getaddrinfo(ip, port, socket.AF_UNSPEC, socket.SOCK_DGRAM)
+        af, socktype, proto, canonname, addr = addrinfo[0]
+        ip, port = addr[:2]
+        sock = socket.socket(af, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuseport:
+            # Lets several processes bind the same port, the kernel
+            # distributes the incoming datagrams between them.
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        if recv_buffer:
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, recv_buffer)
+            actual = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+            if sys.platform.startswith("linux"):
+                # Linux reports twice the size it granted, capped by net.core.rmem_max
+                actual //= 2
+            if actual < recv_buffer:
+                log.warning("Receive buffer of %s:%s limited to %s bytes", ip, port, actual)
+        try:
+            sock.bind((ip, port))
+            log.info("Bound socket socket %s:%s", ip, port)
+        except Exception:
+            log.exception("Error binding socket %s:%s.", ip, port)
+            sys.exit(1)
+        return sock
+
     def run(self):
         setproctitle("bucky: %s" % self.__class__.__name__)
+        if self.recv_batch > 1 and hasattr(socket, "MSG_DONTWAIT"):
+            self.run_batched()
+        else:
+            recvfrom = self.sock_recvfrom
+            while True:
+                try:
+                    data, addr = recvfrom(65535)
+                except (IOError, KeyboardInterrupt):
+                    continue
+                addr = addr[:2]  # for compatibility with longer ipv6 tuples
+                if data == b'EXIT':
+                    break
+                if self.drops_interval:
+                    self.check_drops()
+                if not self.handle(data, addr):
+                    break
+        try:
+            self.pre_shutdown()
+        except Exception:
+            log.exception("Failed pre_shutdown method for %s",
+                          self.__class__.__name__)
+
+    def run_batched(self):
+        """Wait for a datagram, then drain whatever else the socket has ready"""
         recvfrom = self.sock_recvfrom
+        recv_batch = self.recv_batch
+        dontwait = socket.MSG_DONTWAIT
         while True:
             try:
-                data, addr = recvfrom(65535)
+                batch = [recvfrom(65535)]
             except (IOError, KeyboardInterrupt):
                 continue
-            addr = addr[:2]  # for compatibility with longer ipv6 tuples
-            if data == b'EXIT':
+            try:
+                while len(batch) < recv_batch:
+                    batch.append(recvfrom(65535, dontwait))
+            except (IOError, socket.error):
+                pass
+            exiting = False
+            for i, (data, addr) in enumerate(batch):
+                if data == b'EXIT':
+                    del batch[i:]
+                    exiting = True
+                    break
+                # for compatibility with longer ipv6 tuples
+                batch[i] = (data, addr[:2])
+            if self.drops_interval:
+                self.check_drops()
+            if batch and not self.handle_batch(batch):
                 break
-            if not self.handle(data, addr):
+            if exiting:
                 break
-        try:
-            self.pre_shutdown()
-        except Exception:
-            log.exception("Failed pre_shutdown method for %s",
-                          self.__class__.__name__)
+
+    def handle_batch(self, batch):
+        """Handle a list of (data, addr) datagrams received at once"""
+        for data, addr in batch:
+            if not self.handle(data, addr):
+                return False
+        return True
+
+    def check_drops(self):
+        """Publish the kernel drop count of the socket every drops_interval"""
+        now = time.time()
+        if now < self.next_drops_check:
+            return
+        self.next_drops_check = now + self.drops_interval
+        if self.queue is None:
+            return
+        drops = socket_drops(self.sock)
+        if drops is not None:
+            self.queue.put((None, self.drops_name, drops, int(now)))
 
     def handle(self, data, addr):
         raise NotImplementedError()
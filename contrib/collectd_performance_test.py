@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+
+from __future__ import print_function
+
+import os
+import glob
+import struct
+import timeit
+import tempfile
+
+import bucky.cfg
+import bucky.collectd
+
+l10 = range(10)
+
+# Types used by the packet captures in tests/
+TYPESDB = """\
+if_octets rx:DERIVE:0:U, tx:DERIVE:0:U
+if_packets rx:DERIVE:0:U, tx:DERIVE:0:U
+if_errors rx:DERIVE:0:U, tx:DERIVE:0:U
+memory value:GAUGE:0:281474976710656
+df_complex value:GAUGE:0:U
+swap value:GAUGE:0:1099511627776
+users value:GAUGE:0:65535
+gauge value:GAUGE:U:U
+derive value:DERIVE:U:U
+counter value:COUNTER:U:U
+absolute value:ABSOLUTE:U:U
+counters a:COUNTER:0:U, b:COUNTER:0:U
+false_counter value:COUNTER:U:U
+false_derive value:DERIVE:U:U
+"""
+
+
+def pkts(fname):
+    with open(fname, 'rb') as handle:
+        length = handle.read(2)
+        while length:
+            (dlen,) = struct.unpack("!H", length)
+            yield handle.read(dlen)
+            length = handle.read(2)
+
+
+def test_file(name):
+    return os.path.join(os.path.dirname(__file__), "..", "tests", name)
+
+
+def load_packets():
+    pattern = test_file("collectd*.pkts")
+    packets = []
+    for fname in sorted(glob.glob(pattern)):
+        # Encrypted packets need the crypto layer, not just the parser
+        if "encrypted" in fname:
+            continue
+        for pkt in pkts(fname):
+            if "signed" in fname:
+                # Strip the signature part like CollectDCrypto does
+                pkt = pkt[struct.unpack("!HH", pkt[:4])[1]:]
+            packets.append(pkt)
+    return packets
+
+
+with tempfile.NamedTemporaryFile(mode="w", suffix=".db", delete=False) as f:
+    f.write(TYPESDB)
+parser = bucky.collectd.CollectDParser([f.name], counter_eq_derive=True)
+os.unlink(f.name)
+
+packets = load_packets()
+
+
+def parse_packets(parser):
+    nsamples = 0
+    for data in packets:
+        for sample in parser.parse(data):
+            nsamples += 1
+    return nsamples
+
+
+# Warmup
+print("Warmup")
+for i in l10:
+    parse_packets(parser)
+
+print("Test: %d packets, %d samples" % (len(packets), parse_packets(parser)))
+trun = timeit.timeit('parse_packets(parser)',
+                     'from __main__ import parse_packets, parser',
+                     number=1000)
+print("parse_packets: %d packets/sec" % (1000 * len(packets) / trun))
+
+
+# Crypto, the test captures are signed and encrypted by user alice
+with tempfile.NamedTemporaryFile(mode="w", delete=False) as f:
+    f.write("alice: 12345678\n")
+bucky.cfg.collectd_auth_file = f.name
+
+
+def crypto_packets(fname):
+    return list(pkts(test_file(fname)))
+
+
+def crypto_parse(crypto, packets):
+    for data in packets:
+        crypto.parse(data)
+
+
+for sec_level, fname in ((1, "collectd-squares-signed.pkts"),
+                         (2, "collectd-squares-encrypted.pkts")):
+    bucky.cfg.collectd_security_level = sec_level
+    crypto = bucky.collectd.CollectDCrypto(bucky.cfg)
+    packets = crypto_packets(fname)
+    for i in l10:
+        crypto_parse(crypto, packets)
+    trun = timeit.timeit(lambda: crypto_parse(crypto, packets), number=1000)
+    print("crypto_parse %s: %d packets/sec" % (fname, 1000 * len(packets) / trun))
+    crypto.cfg_mon.stop()
+os.unlink(f.name)
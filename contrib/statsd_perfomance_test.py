@@ -22,6 +22,13 @@ queue = multiprocessing.Queue()
 
 handler = bucky.statsd.StatsDHandler(queue, bucky.cfg)
 
+# Without the key cache handle_line is the per line path StatsDServer used
+# before datagrams were parsed as bytes, the baseline for the parser.
+key_cache_size = bucky.cfg.statsd_key_cache_size
+bucky.cfg.statsd_key_cache_size = 0
+uncached_handler = bucky.statsd.StatsDHandler(queue, bucky.cfg)
+bucky.cfg.statsd_key_cache_size = key_cache_size
+
 
 def fill_and_compute_timers(handler):
     # Fill timers
@@ -31,7 +38,8 @@ def fill_and_compute_timers(handler):
 
     # Compute metrics
     stime = int(time.time())
-    handler.enqueue_timers(stime)
+    handler.enqueue_timers(handler.timers, stime)
+    handler.timers = {}
 
     # Clear queue
     while not queue.empty():
@@ -49,11 +57,46 @@ def line_parsing_stress(handler):
         queue.get()
 
 
+def make_lines():
+    lines = []
+    for x in l1000:
+        lines.append("counter-%s:1|c" % (x % 100))
+        lines.append("counter-%s:2|c|@0.5" % (x % 100))
+        lines.append("timer-%s:%s|ms" % (x % 100, x))
+        lines.append("gauge-%s:%s|g" % (x % 100, x))
+        lines.append("set-%s:%s|s" % (x % 100, x))
+    return lines
+
+
+parse_lines = make_lines()
+# Pack the lines into datagrams of 20 lines as clients batching lines would
+parse_datagrams = ["\n".join(parse_lines[i:i + 20]).encode()
+                   for i in range(0, len(parse_lines), 20)]
+
+
+def handle_line_parsing(handler):
+    # Decoded and handled line by line like the original StatsDServer did
+    for data in parse_datagrams:
+        for line in data.decode().splitlines():
+            handler.line = line
+            if not line.strip():
+                continue
+            handler.handle_line(line)
+
+
+def handle_datagram_parsing(handler):
+    for data in parse_datagrams:
+        handler.handle(data)
+
+
 # Warmup
 print("Warmup")
 for i in l10:
     fill_and_compute_timers(handler)
     line_parsing_stress(handler)
+    handle_line_parsing(uncached_handler)
+    handle_datagram_parsing(uncached_handler)
+    handle_datagram_parsing(handler)
 
 print("Test")
 trun = timeit.timeit('fill_and_compute_timers(handler)',
@@ -65,6 +108,14 @@ trun = timeit.timeit('line_parsing_stress(handler)',
                      number=100)
 print("Result:", trun)
 
+for func, target in (("handle_line_parsing", "uncached_handler"),
+                     ("handle_datagram_parsing", "uncached_handler"),
+                     ("handle_datagram_parsing", "handler")):
+    trun = timeit.timeit('%s(%s)' % (func, target),
+                         'from __main__ import %s, %s' % (func, target),
+                         number=20)
+    print("%s(%s): %d lines/sec" % (func, target, 20 * len(parse_lines) / trun))
+
 if platform.system() in ("Darwin", ):
     qsize = 0
     while not queue.empty():
@@ -16,8 +16,30 @@
 
 import t
 import os
+import sys
+import array
+import socket
+import random
+import logging
+import time
+import unittest
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import bucky.statsd
+import bucky.udpserver
+from bucky.errors import ConfigError
+from bucky.frames import SampleFrame
+from bucky.metrics.stats.ddsketch import DDSketch
+from bucky.metrics.stats.hyperloglog import HyperLogLog
 
 
 TIMEOUT = 3
@@ -237,3 +259,492 @@ def test_simple_persistent_gauges(q, s):
         if os.path.isfile(os.path.join(t.cfg.directory, t.cfg.statsd_gauges_savefile)):
             os.unlink(os.path.join(t.cfg.directory, t.cfg.statsd_gauges_savefile))
         os.removedirs(t.cfg.directory)
+
+
+@t.set_cfg("statsd_persistent_gauges", True)
+@t.set_cfg("statsd_gauges_journal", True)
+@t.set_cfg("statsd_gauges_journal_compact_interval", 3600)
+@t.set_cfg("directory", "/tmp/var_lib_bucky_journal")
+def test_gauges_journal():
+    if not os.path.isdir(t.cfg.directory):
+        os.makedirs(t.cfg.directory)
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    try:
+        handler.load_gauges()
+        handler.handle(b"gorm:5|g\ngurm:1|g#env=prod")
+        handler.tick()
+        handler.handle(b"gorm:+2|g")
+        handler.tick()
+        handler.handle(b"gurm:3|g#env=prod")
+        handler.save_gauges()
+        handler.journal.write(b'{"gorm": [1')  # torn write
+        handler.journal.close()
+        with open(handler.journal_filename, "rb") as f:
+            t.eq(len(f.readlines()), 4)
+
+        loaded = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+        loaded.load_gauges()
+        t.eq(loaded.gauges, {"gorm": 7, "gurm": 3})
+        t.eq(loaded.keys_seen["gurm"], {"env": "prod"})
+        # Replayed journal is compacted into the snapshot
+        t.eq(os.path.getsize(loaded.journal_filename), 0)
+        t.eq(bucky.statsd.read_json_file(loaded.gauges_filename)["gorm"][0], 7)
+        loaded.journal.close()
+
+        # Without a writable snapshot the gauges are saved without journal
+        os.mkdir(loaded.gauges_filename + ".tmp")
+        unwritable = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+        unwritable.load_gauges()
+        t.eq(unwritable.journal, None)
+        t.eq(unwritable.gauges, {"gorm": 7, "gurm": 3})
+        os.rmdir(loaded.gauges_filename + ".tmp")
+    finally:
+        for name in os.listdir(t.cfg.directory):
+            os.unlink(os.path.join(t.cfg.directory, name))
+        os.removedirs(t.cfg.directory)
+
+
+def close_stat(name, value, stat, accuracy=0.01):
+    t.eq(name, stat[1])
+    t.lt(abs(stat[2] - value), abs(value) * accuracy + 1e-9)
+    t.gt(stat[3], 0)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8134)
+@t.set_cfg("statsd_timer_sketch", True)
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_timer_sketch(q, s):
+    s.send("gorm:2|ms")
+    s.send("gorm:5|ms")
+    s.send("gorm:7|ms")  # Out of the 90% threshold
+    s.send("gorm:3|ms")
+    close_stat("stats.timers.gorm.mean_90", 10 / 3.0, q.get(timeout=TIMEOUT))
+    close_stat("stats.timers.gorm.upper_90", 5, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.count_90", 3, q.get(timeout=TIMEOUT))
+    close_stat("stats.timers.gorm.sum_90", 10, q.get(timeout=TIMEOUT))
+    close_stat("stats.timers.gorm.sum_squares_90", 38, q.get(timeout=TIMEOUT), 0.03)
+    t.same_stat(None, "stats.timers.gorm.mean", 17 / 4.0, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.upper", 7, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.lower", 2, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.count", 4, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.count_ps", 8, q.get(timeout=TIMEOUT))
+    close_stat("stats.timers.gorm.median", 4, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.sum", 17, q.get(timeout=TIMEOUT))
+    t.same_stat(None, "stats.timers.gorm.sum_squares", 87, q.get(timeout=TIMEOUT))
+    close_stat("stats.timers.gorm.std", 1.920286436967152, q.get(timeout=TIMEOUT), 1e-6)
+    t.same_stat(None, "stats.numStats", 1, q.get(timeout=TIMEOUT))
+
+
+@t.set_cfg("statsd_timer_sketch", True)
+def test_timer_non_finite():
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    handler.handle(b"gorm:inf|ms\ngorm:1e400|ms\ngorm:nan|ms\ngorm:2|ms\ngurm:1|c")
+    t.eq(handler.counters, {"gurm": 1})
+    t.eq(len(handler.timers["gorm"]), 1)
+    handler.handle_line("gorm:-inf|ms")
+    t.eq(len(handler.timers["gorm"]), 1)
+
+
+def test_ddsketch_accuracy():
+    values = [random.expovariate(0.01) for i in range(10000)]
+    sketch = DDSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.update(value)
+    values.sort()
+    t.eq(len(sketch), len(values))
+    t.eq(sketch.min, values[0])
+    t.eq(sketch.max, values[-1])
+    for rank in (0, 10, 500, 5000, 9000, 9899, 9999):
+        value = sketch.value_at_rank(rank)
+        t.lt(abs(value - values[rank]), values[rank] * 0.01 + 1e-9)
+    vsum, vsum_squares = sketch.head(9000)
+    t.lt(abs(vsum - sum(values[:9000])), sum(values[:9000]) * 0.01)
+
+
+def test_ddsketch_merge():
+    values = [random.uniform(-100, 1000) for i in range(2000)]
+    whole = DDSketch()
+    parts = [DDSketch(), DDSketch()]
+    for i, value in enumerate(values):
+        whole.update(value)
+        parts[i % 2].update(value)
+    parts[0].merge(parts[1])
+    t.eq(parts[0].count, whole.count)
+    t.eq(parts[0].min, whole.min)
+    t.eq(parts[0].max, whole.max)
+    t.eq(list(parts[0].buckets()), list(whole.buckets()))
+    t.raises(ValueError, parts[0].merge, DDSketch(relative_accuracy=0.05))
+
+
+def test_ddsketch_bounded():
+    sketch = DDSketch(relative_accuracy=0.01, max_bins=64)
+    for i in range(1, 100000, 7):
+        sketch.update(float(i))
+    t.eq(len(sketch.positive), 64)
+    t.eq(sketch.value_at_rank(sketch.count - 1), 99996.0)
+
+
+@t.set_cfg("statsd_percentile_thresholds", [50, 90, 99, 99.9])
+@t.set_cfg("statsd_timer_numpy", True)
+def test_timer_numpy():
+    if numpy is None:
+        raise unittest.SkipTest("numpy is not installed")
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    for count in (1, 2, 3, 10, 1001, 1001, 1001, 10000):
+        values = [random.expovariate(0.01) for i in range(count)]
+        expected = handler.timer_stats_values(list(values))
+        result = handler.timer_stats_numpy(array.array('d', values))
+        t.eq(result, expected)
+        for stat in result[1]:
+            t.istype(stat, (int, float))
+
+
+@t.set_cfg("statsd_timer_numpy", True)
+@t.set_cfg("statsd_timer_sketch", True)
+def test_timer_numpy_sketch_exclusive():
+    t.raises(ConfigError, bucky.statsd.StatsDHandler, queue.Queue(), t.cfg)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8135)
+@t.set_cfg("statsd_flush_frames", True)
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_flush_frames(q, s):
+    s.send("gorm:1|c")
+    s.send("gurm:5|g")
+    frame = q.get(timeout=TIMEOUT)
+    t.istype(frame, SampleFrame)
+    t.eq(frame.host, None)
+    t.gt(frame.time, 0)
+    samples = list(frame)
+    t.eq(len(samples), 4)
+    t.same_stat(None, "stats.gorm", 2, samples[0])
+    t.same_stat(None, "stats_counts.gorm", 1, samples[1])
+    t.same_stat(None, "stats.gauges.gurm", 5, samples[2])
+    t.same_stat(None, "stats.numStats", 2, samples[3])
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8136)
+@t.set_cfg("statsd_flush_frames", True)
+@t.set_cfg("statsd_frame_size", 2)
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_flush_frames_chunked(q, s):
+    s.send("gorm:1|c")
+    s.send("gurm:5|g")
+    t.eq(len(q.get(timeout=TIMEOUT)), 2)
+    t.eq(len(q.get(timeout=TIMEOUT)), 2)
+
+
+@t.set_cfg("statsd_metadata", {"env": "test"})
+@t.set_cfg("statsd_flush_frames", True)
+def test_flush_frames_metadata():
+    q = queue.Queue()
+    handler = bucky.statsd.StatsDHandler(q, t.cfg)
+    handler.handle_line("gorm:1|c#tag=value")
+    handler.handle_line("gurm:1|c")
+    handler.tick()
+    frame = q.get_nowait()
+    t.eq(frame.metadata, {"env": "test"})
+    samples = list(frame)
+    t.eq(samples[0][4], {"tag": "value", "env": "test"})
+    t.eq(samples[2][4], {"env": "test"})
+    t.eq(samples[-1][4], {"env": "test"})
+    t.eq(len(frame), 5)
+
+
+def flushed_stats(q):
+    stats = {}
+    while not q.empty():
+        sample = q.get_nowait()
+        stats[sample[1]] = sample[2]
+    return stats
+
+
+def test_idle_stats():
+    q = queue.Queue()
+    handler = bucky.statsd.StatsDHandler(q, t.cfg)
+    handler.handle_line("gorm:1|c")
+    handler.handle_line("gurm:1|ms")
+    handler.handle_line("garm:1|s")
+    handler.handle_line("girm:1|g")
+    handler.tick()
+    t.eq(len(flushed_stats(q)), 14)
+    handler.tick()
+    stats = flushed_stats(q)
+    t.eq(stats["stats_counts.gorm"], 0)
+    t.eq(stats["stats.timers.gurm.count"], 0)
+    t.eq(stats["stats.sets.garm.count"], 0)
+    t.eq(stats["stats.gauges.girm"], 1)
+    t.eq(stats["stats.numStats"], 4)
+
+
+@t.set_cfg("statsd_delete_idlestats", True)
+def test_delete_idle_stats():
+    q = queue.Queue()
+    handler = bucky.statsd.StatsDHandler(q, t.cfg)
+    handler.handle_line("gorm:1|c")
+    handler.handle_line("gurm:1|ms")
+    handler.handle_line("garm:1|s")
+    handler.handle_line("girm:1|g")
+    handler.tick()
+    t.eq(flushed_stats(q)["stats.numStats"], 4)
+    handler.handle_line("gorm:1|c")
+    handler.tick()
+    t.eq(flushed_stats(q), {"stats.gorm": 0.1, "stats_counts.gorm": 1, "stats.numStats": 1})
+    handler.tick()
+    t.eq(flushed_stats(q), {"stats.numStats": 0})
+
+
+class IngestingQueue(queue.Queue):
+    """Receives a line on the handler for every stat flushed"""
+
+    def __init__(self, handler):
+        queue.Queue.__init__(self)
+        self.handler = handler
+
+    def put(self, item, *args, **kwargs):
+        self.handler.handle_line("gorm:1|c")
+        queue.Queue.put(self, item, *args, **kwargs)
+
+
+def test_flush_outside_lock():
+    handler = bucky.statsd.StatsDHandler(None, t.cfg)
+    handler.queue = IngestingQueue(handler)
+    handler.handle_line("gorm:1|c")
+    handler.tick()
+    stats = flushed_stats(handler.queue)
+    t.eq(stats["stats_counts.gorm"], 1)
+    t.eq(handler.counters["gorm"], 3)
+
+
+DATAGRAM_LINES = [
+    "gorm:1|c",
+    "gorm:2|c|@0.5",
+    "gorm:2|c|@bad",
+    "gurm:100|ms:200|ms",
+    "gurm:300|ms",
+    "girm:5|g",
+    "girm:+3|g",
+    "girm:-1|g",
+    "garm:alice|s",
+    "garm:bob|s",
+    "garm:alice|s",
+    "tagged.name:1|c#env=prod,role:web,flag",
+    "spaced name/with$junk:4|c",
+    "",
+    "missing_value",
+    "bad_value:x|ms",
+    "bad_sample:1",
+]
+
+
+@t.set_cfg("statsd_metadata", {"dc": "ams"})
+def test_handle_datagram():
+    legacy = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    for line in DATAGRAM_LINES:
+        if line.strip():
+            legacy.line = line
+            legacy.handle_line(line)
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    handler.handle("\n".join(DATAGRAM_LINES).encode())
+    t.eq(handler.timers, legacy.timers)
+    t.eq(handler.counters, legacy.counters)
+    t.eq(handler.gauges, legacy.gauges)
+    t.eq(handler.sets, legacy.sets)
+    t.eq(handler.keys_seen, legacy.keys_seen)
+    t.eq(handler.counters["spaced_name-withjunk"], 4)
+    t.eq(handler.keys_seen["tagged.name"], {"env": "prod", "role": "web", "flag": None, "dc": "ams"})
+
+
+def test_key_cache():
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    cache = handler.key_cache
+    t.eq(handler.sanitize_key(b"some key/with$junk"), "some_key-withjunk")
+    t.eq((cache.hits, cache.misses), (0, 1))
+    t.eq(handler.sanitize_key(b"some key/with$junk"), "some_key-withjunk")
+    t.eq((cache.hits, cache.misses), (1, 1))
+    handler.handle(b"some key/with$junk:1|c\nother:2|c")
+    t.eq((cache.hits, cache.misses), (2, 2))
+    t.eq(handler.counters, {"some_key-withjunk": 1, "other": 2})
+
+
+@t.set_cfg("statsd_key_cache_size", 0)
+def test_key_cache_disabled():
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    t.eq(handler.key_cache, None)
+    handler.handle(b"some key/with$junk:1|c")
+    t.eq(handler.counters, {"some_key-withjunk": 1})
+
+
+@t.set_cfg("statsd_set_hyperloglog", True)
+def test_set_hyperloglog():
+    q = queue.Queue()
+    handler = bucky.statsd.StatsDHandler(q, t.cfg)
+    handler.handle(b"\n".join(b"users:" + str(i % 1000).encode() + b"|s" for i in range(5000)))
+    handler.handle_line("users:1|s")
+    t.eq(type(handler.sets["users"]), HyperLogLog)
+    handler.tick()
+    stat = q.get(timeout=TIMEOUT)
+    close_stat("stats.sets.users.count", 1000, stat, 0.05)
+
+
+def test_hyperloglog_accuracy():
+    for n in (0, 1, 100, 10000):
+        hll = HyperLogLog(12)
+        for i in range(n):
+            hll.add("member-%d" % i)
+            hll.add(b"member-%d" % i if i % 2 else u"member-%d" % i)
+        t.lt(abs(hll.cardinality() - n), n * 3 * 1.04 / 64 + 1e-9)
+
+
+def test_hyperloglog_merge():
+    a, b, both = HyperLogLog(), HyperLogLog(), HyperLogLog()
+    for i in range(3000):
+        (a if i < 2000 else b).add(str(i))
+        both.add(str(i))
+    b.add("0")
+    a.merge(b)
+    t.eq(a.registers, both.registers)
+    t.raises(ValueError, a.merge, HyperLogLog(10))
+
+
+def test_workers_merge():
+    shards = []
+    for datagram in (b"gorm:1|c\ngurm:2|ms\nsets:a|s\ngauge:1|g",
+                     b"gorm:2|c\ngurm:4|ms\nsets:b|s\ngauge:2|g#env=prod"):
+        shard = bucky.statsd.StatsDHandler(None, t.cfg)
+        shard.gauge_updates = {}
+        shard.handle(datagram)
+        shards.append(shard)
+    server = bucky.statsd.StatsDServerMP(queue.Queue(), t.cfg)
+    # The last received gauge wins regardless of the worker order
+    generations = [shard.swap() for shard in reversed(shards)]
+    timers, counters, gauges, sets, keys_seen = server.merge(generations)
+    t.eq(counters, {"gorm": 3})
+    t.eq(sorted(timers["gurm"]), [2.0, 4.0])
+    t.eq(sets, {"sets": set(["a", "b"])})
+    t.eq(gauges, {"gauge": 2.0})
+    t.eq(keys_seen["gauge"], {"env": "prod"})
+    # Gauges without updates keep their value
+    t.eq(server.merge([shard.swap() for shard in shards])[2], {"gauge": 2.0})
+
+
+def test_workers_relative_gauges():
+    shards = [bucky.statsd.StatsDHandler(None, t.cfg) for i in range(2)]
+    for shard in shards:
+        shard.gauge_updates = {}
+    server = bucky.statsd.StatsDServerMP(queue.Queue(), t.cfg)
+    server.handler.gauges["gauge"] = 10.0
+
+    def merge(*datagrams):
+        for shard, datagram in zip(shards, datagrams):
+            shard.handle(datagram)
+            time.sleep(.01)
+        return server.merge([shard.swap() for shard in shards])[2]["gauge"]
+
+    # Relative updates of all workers apply to the merged value
+    t.eq(merge(b"gauge:+2|g\ngauge:+1|g", b"gauge:-5|g"), 8.0)
+    t.eq(merge(b"gauge:+2|g", b""), 10.0)
+    # and only the ones received after the most recent value
+    t.eq(merge(b"gauge:+3|g", b"gauge:1|g\ngauge:+1|g"), 2.0)
+    t.eq(merge(b"gauge:4|g\ngauge:-1|g", b"gauge:+3|g"), 6.0)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8137)
+@t.set_cfg("statsd_workers", 2)
+@t.udp_srv(bucky.statsd.getStatsDServer)
+def test_workers(q, s):
+    t.istype(s, bucky.statsd.StatsDServerMP)
+    # The first flush happens once the workers are bound
+    t.same_stat(None, "stats.numStats", 0, q.get(timeout=TIMEOUT))
+    # Different source ports spread the datagrams over the workers
+    for i in range(20):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.sendto(b"gorm:1|c", (s.ip, s.port))
+        sock.close()
+    total = 0
+    for i in range(50):
+        stat = q.get(timeout=TIMEOUT)
+        if stat[1] == "stats_counts.gorm":
+            total += stat[2]
+            if total >= 20:
+                break
+    t.eq(total, 20)
+
+
+@t.set_cfg("statsd_flush_time", 0.5)
+@t.set_cfg("statsd_port", 8138)
+@t.set_cfg("udp_recv_batch", 16)
+@t.udp_srv(bucky.statsd.StatsDServer)
+def test_recv_batch(q, s):
+    for i in range(100):
+        s.send("gorm:1|c")
+    total = 0
+    for i in range(50):
+        stat = q.get(timeout=TIMEOUT)
+        if stat[1] == "stats_counts.gorm":
+            total += stat[2]
+            if total >= 100:
+                break
+    t.eq(total, 100)
+
+
+def test_handle_batch():
+    handler = bucky.statsd.StatsDHandler(queue.Queue(), t.cfg)
+    handler.handle_batch([b"gorm:1|c\ngurm:2|g", b"gorm:2|c", b"gurm:+1|g"])
+    t.eq(handler.counters, {"gorm": 3})
+    t.eq(handler.gauges, {"gurm": 3})
+
+
+@t.set_cfg("statsd_port", 8139)
+@t.set_cfg("statsd_recv_buffer", 65536)
+def test_udp_drops():
+    q = queue.Queue()
+    server = bucky.statsd.StatsDServer(q, t.cfg)
+    try:
+        t.gt(server.sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF), 0)
+        if bucky.udpserver.socket_drops(server.sock) is None:
+            raise unittest.SkipTest("No /proc/net/udp")
+        server.next_drops_check = 0
+        server.check_drops()
+        t.same_stat(None, "bucky.StatsDServer.udp_drops", 0, q.get_nowait())
+        # Not published again before the interval passed
+        server.check_drops()
+        t.eq(q.empty(), True)
+    finally:
+        server.sock.close()
+
+
+class LogRecorder(logging.Handler):
+    def __init__(self):
+        super(LogRecorder, self).__init__(logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+
+def recv_buffer_warnings(size):
+    recorder = LogRecorder()
+    bucky.udpserver.log.addHandler(recorder)
+    try:
+        server = t.set_cfg("statsd_recv_buffer", size)(bucky.statsd.StatsDServer)(queue.Queue(), t.cfg)
+        server.sock.close()
+    finally:
+        bucky.udpserver.log.removeHandler(recorder)
+    return recorder.messages
+
+
+@t.set_cfg("statsd_port", 8139)
+def test_recv_buffer_limit():
+    if not sys.platform.startswith("linux") or not os.path.exists("/proc/sys/net/core/rmem_max"):
+        raise unittest.SkipTest("No net.core.rmem_max")
+    with open("/proc/sys/net/core/rmem_max") as f:
+        rmem_max = int(f.read())
+    # The kernel caps the buffer at rmem_max, reporting twice that
+    t.eq(recv_buffer_warnings(rmem_max * 2),
+         ["Receive buffer of 127.0.0.1:8139 limited to %d bytes" % rmem_max])
+    t.eq(recv_buffer_warnings(rmem_max // 2), [])
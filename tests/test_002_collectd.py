@@ -16,7 +16,12 @@
 
 import os
 import time
+import signal
+import multiprocessing
+import socket
+import threading
 import struct
+import unittest
 try:
     import queue
 except ImportError:
@@ -24,6 +29,8 @@ except ImportError:
 
 import t
 import bucky.collectd
+import bucky.errors
+import bucky.helpers
 from bucky import cfg
 from bucky.errors import ProtocolError
 
@@ -74,6 +81,21 @@ def authfile(data):
 def send_get_data(q, s, datafile):
     for pkt in pkts(datafile):
         s.send(pkt)
+    return get_data(q)
+
+
+def sendto_get_data(q, s, datafile):
+    # From a socket of its own, every call uses another source port
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        for pkt in pkts(datafile):
+            sock.sendto(pkt, (s.ip, s.port))
+    finally:
+        sock.close()
+    return get_data(q)
+
+
+def get_data(q):
     time.sleep(.1)
     while True:
         try:
@@ -228,6 +250,495 @@ def test_net_enc(q, s):
     check_samples(samples, seq, 10, 'test.squares.gauge')
 
 
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25839)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_reuseport", True)
+@t.udp_srv(bucky.collectd.getCollectDServer)
+def test_reuseport_workers(q, s):
+    t.istype(s, bucky.collectd.CollectDServerReusePort)
+    # Give the workers time to bind
+    time.sleep(.5)
+    samples = list(sendto_get_data(q, s, 'collectd-squares.pkts'))
+    # All packets of a source go to one worker, derived rates need the
+    # previous sample of the same worker
+    check_samples(samples, lambda i: i ** 2, 10, 'test.squares.gauge')
+    check_samples(samples, lambda i: (2 * i + 1) / 2., 9, 'test.squares.derive')
+
+
+def test_types_cache():
+    types = "load a:GAUGE:U:U, b:GAUGE:0:10\nmixed a:GAUGE:U:U, b:DERIVE:U:U\n"
+    with t.unlinking(t.temp_file(types)) as path:
+        with t.unlinking(t.temp_file("")) as cache:
+            parsed = bucky.collectd.CollectDTypes([path], cache_file=cache)
+            cached = bucky.collectd.CollectDTypes([path], cache_file=cache)
+            t.eq(cached.types, parsed.types)
+            t.eq(cached.type_ranges, parsed.type_ranges)
+            t.eq(cached.type_signatures, parsed.type_signatures)
+            t.eq(cached.value_structs["load"].format, parsed.value_structs["load"].format)
+            t.eq(cached.value_structs["mixed"], None)
+            # Changes to the types.db invalidate the cache
+            with open(path, "a") as f:
+                f.write("other value:COUNTER:U:U\n")
+            t.eq(bucky.collectd.CollectDTypes([path], cache_file=cache).get("other"),
+                 [("value", 0)])
+            # Broken and truncated caches are parsed again
+            with open(cache, "rb") as f:
+                data = f.read()
+            for broken in (b"garbage", b"", data[:len(data) // 2]):
+                with open(cache, "wb") as f:
+                    f.write(broken)
+                t.eq(len(bucky.collectd.CollectDTypes([path], cache_file=cache).types), 3)
+            t.eq([name for name in os.listdir(os.path.dirname(cache)) if name.endswith(".tmp")], [])
+
+
+def test_writer():
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+    data = list(pkts('collectd-squares.pkts'))
+    samples = [s for pkt in data for s in parser.parse(pkt)]
+    writer = bucky.collectd.CollectDWriter(mtu=512)
+    for sample in samples:
+        writer.add(sample.header, [(sample.value_type, sample.value)])
+    writer.flush()
+    packets = writer.take()
+    t.eq(max(len(packet) for packet in packets) <= 512, True)
+    t.eq([dict(s) for pkt in packets for s in parser.parse(pkt)],
+         [dict(s) for s in samples])
+    writer = bucky.collectd.CollectDWriter(mtu=65507)
+    for sample in samples:
+        writer.add(sample.header, [(sample.value_type, sample.value)])
+    writer.flush()
+    packets = writer.take()
+    t.eq(len(packets), 1)
+    # Header parts shared by the source packets are written once
+    t.lt(len(packets[0]), sum(map(len, data)))
+    # Signed packets are accepted by CollectDCrypto
+    writer = bucky.collectd.CollectDWriter(mtu=512, username="alice", password="12345678")
+    writer.add(samples[0].header, [(samples[0].value_type, samples[0].value)])
+    writer.flush()
+    packet = writer.take()[0]
+    t.eq(packet[:4], struct.pack("!HH", 0x0200, 4 + 32 + 5))
+    crypto = cfg_crypto(1, "alice: 12345678")
+    t.eq([dict(s) for s in parser.parse(crypto.parse(packet))], [dict(samples[0])])
+    crypto = cfg_crypto(1, "alice: 87654321")
+    t.raises(ProtocolError, crypto.parse, packet)
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_forward_ip", "127.0.0.1")
+@t.set_cfg("collectd_forward_port", 25842)
+@t.set_cfg("collectd_forward_interval", 3600)
+def test_forwarder():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 25842))
+    sock.settimeout(1)
+    try:
+        handler = bucky.collectd.CollectDHandler(cfg)
+        data = list(pkts('collectd-squares.pkts'))
+        for pkt in data:
+            list(handler.parse(pkt))
+        handler.shutdown()
+        forwarded = []
+        while True:
+            try:
+                forwarded.append(sock.recv(65535))
+            except socket.timeout:
+                break
+    finally:
+        sock.close()
+    # The capture already holds full packets, nothing to combine
+    t.eq(len(forwarded), len(data))
+    parser = handler.parser
+    t.eq([dict(s) for pkt in forwarded for s in parser.parse(pkt)],
+         [dict(s) for pkt in data for s in parser.parse(pkt)])
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_forward_ip", "127.0.0.1")
+@t.set_cfg("collectd_forward_port", 25845)
+@t.set_cfg("collectd_forward_mtu", 65507)
+@t.set_cfg("collectd_forward_interval", .2)
+def test_forwarder_interval():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(("127.0.0.1", 25845))
+    sock.settimeout(2)
+    try:
+        handler = bucky.collectd.CollectDHandler(cfg)
+        data = list(pkts('collectd-squares.pkts'))[:3]
+        for pkt in data:
+            list(handler.parse(pkt))
+        # Sent without another packet arriving or a shutdown
+        forwarded = sock.recv(65535)
+        parser = handler.parser
+        t.eq([dict(s) for s in parser.parse(forwarded)],
+             [dict(s) for pkt in data for s in parser.parse(pkt)])
+        handler.shutdown()
+        sock.settimeout(.5)
+        t.raises(socket.timeout, sock.recv, 65535)
+    finally:
+        sock.close()
+
+
+def test_rollup():
+    rollup = bucky.collectd.CollectDRollup(60, "max")
+    t.eq(rollup.add("h", "a", 1, 120), None)
+    t.eq(rollup.add("h", "a", 3, 150), None)
+    t.eq(rollup.add("h", "b", 5, 170), None)
+    t.eq(rollup.add("h", "a", 2, 179), None)
+    t.eq(rollup.add("h", "a", 4, 180), ("h", "a", 3, 120))
+    # Windows that ended more than a window ago are emitted
+    t.eq(rollup.expire(300), [("h", "b", 5, 120)])
+    # Checked once per window
+    t.eq(rollup.expire(305), [])
+    t.eq(rollup.flush(), [("h", "a", 4, 180)])
+    t.eq(rollup.series, {})
+    rollup = bucky.collectd.CollectDRollup(10, "last")
+    rollup.add("h", "a", 1, 10)
+    rollup.add("h", "a", 2, 11)
+    t.eq(rollup.flush(), [("h", "a", 2, 10)])
+    t.raises(bucky.errors.ConfigError, bucky.collectd.CollectDRollup, 10, "median")
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_rollup_window", 10)
+def test_rollup_handler():
+    handler = bucky.collectd.CollectDHandler(cfg)
+    samples = [s for pkt in pkts('collectd-squares.pkts') for s in handler.parse(pkt)]
+    samples.extend(handler.shutdown())
+    # Gauge values i^2 every 2 seconds from 1395422373
+    t.eq([s[2:] for s in samples if s[1] == 'test.squares.gauge'],
+         [(3.5, 1395422370), (38.0, 1395422380), (81.0, 1395422390)])
+
+
+def test_samples_file():
+    samples = {
+        ("host", "derive"): (-3, 100),
+        ("host", "counter"): (2 ** 64 - 1, 100),
+        (u"h\xf8st", "absolute"): (5, 50),
+        ("host", "float"): (0.5, 100),
+    }
+    with t.unlinking(t.temp_file("")) as path:
+        bucky.collectd.CollectDSamplesFile.write(path, samples)
+        t.eq(dict(bucky.collectd.CollectDSamplesFile.read(path)), samples)
+        loaded = dict(bucky.collectd.CollectDSamplesFile.read(path, min_time=100))
+        t.eq(sorted(loaded), [("host", "counter"), ("host", "derive"), ("host", "float")])
+        with open(path, "rb") as f:
+            data = f.read()
+        with open(path, "wb") as f:
+            f.write(data[:-1])
+        t.raises(ProtocolError, lambda: list(bucky.collectd.CollectDSamplesFile.read(path)))
+        with open(path, "wb") as f:
+            f.write(b"gorm" + data[4:])
+        t.raises(ProtocolError, lambda: list(bucky.collectd.CollectDSamplesFile.read(path)))
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_persistent_samples", True)
+@t.set_cfg("collectd_samples_max_age", 0)
+@t.set_cfg("directory", "/tmp/var_lib_bucky_samples")
+def test_persistent_samples():
+    if not os.path.isdir(cfg.directory):
+        os.makedirs(cfg.directory)
+    data = list(pkts('collectd-squares.pkts'))
+    try:
+        handler = bucky.collectd.CollectDHandler(cfg, 1)
+        before = [s for pkt in data[:5] for s in handler.parse(pkt)]
+        handler.save_samples()
+        t.eq(os.listdir(cfg.directory), ["collectd_samples.save.1"])
+        # A restarted server picks up where the previous one stopped,
+        # whichever worker saved the samples
+        handler = bucky.collectd.CollectDHandler(cfg)
+        after = [s for pkt in data[5:] for s in handler.parse(pkt)]
+        derives = [s for s in before + after if s[1] == 'test.squares.derive']
+        t.eq(len(derives), 9)
+        handler.save_samples()
+
+        # Samples older than max age are not loaded
+        @t.set_cfg("collectd_samples_max_age", 600)
+        def load_recent():
+            return bucky.collectd.CollectDHandler(cfg)
+        t.eq(load_recent().prev_samples, {})
+        # Loaded samples of series not seen again in time are dropped
+        fresh = bucky.collectd.CollectDHandler(cfg)
+        t.eq(len(fresh.prev_samples), 3)
+        list(fresh.parse(host_packets("other", 'collectd-squares.pkts')[0]))
+        t.eq(len(fresh.prev_samples), 6)
+        fresh.samples_ttl = 0
+        fresh.loaded_expire = fresh.next_samples_check = 0
+        fresh.check_samples()
+        t.eq(sorted(set(host for host, name in fresh.prev_samples)), ["other"])
+        # Series idle for longer than the TTL are forgotten
+        stime = max(stime for value, stime in handler.prev_samples.values())
+        handler.samples_ttl = 60
+        handler.expire_samples(stime + 30)
+        t.eq(len(handler.prev_samples), 3)
+        handler.expire_samples(stime + 90)
+        t.eq(handler.prev_samples, {})
+    finally:
+        for name in os.listdir(cfg.directory):
+            os.unlink(os.path.join(cfg.directory, name))
+        os.removedirs(cfg.directory)
+
+
+def child_pids(pid):
+    path = "/proc/%d/task/%d/children" % (pid, pid)
+    if not os.path.exists(path):
+        raise unittest.SkipTest("No /proc/<pid>/task/<tid>/children")
+    with open(path) as handle:
+        return set(int(child) for child in handle.read().split())
+
+
+def kill_worker(s):
+    time.sleep(.5)
+    workers = child_pids(s.pid)
+    t.eq(len(workers), 2)
+    os.kill(min(workers), signal.SIGKILL)
+    time.sleep(.2)
+    return workers
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25840)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("supervise_interval", 0.1)
+@t.udp_srv(bucky.collectd.getCollectDServer)
+def test_restart_worker(q, s):
+    t.istype(s, bucky.collectd.CollectDServerMP)
+    workers = kill_worker(s)
+    # Packets routed to the dead worker go to its replacement
+    samples = list(send_get_data(q, s, 'collectd-squares.pkts'))
+    check_samples(samples, lambda i: i ** 2, 10, 'test.squares.gauge')
+    restarted = child_pids(s.pid)
+    t.eq(len(restarted), 2)
+    t.ne(restarted, workers)
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25841)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_reuseport", True)
+@t.set_cfg("supervise_interval", 0.1)
+@t.udp_srv(bucky.collectd.getCollectDServer)
+def test_restart_socket_worker(q, s):
+    workers = kill_worker(s)
+    time.sleep(.5)
+    restarted = child_pids(s.pid)
+    t.eq(len(restarted), 2)
+    t.ne(restarted, workers)
+    # The replacement took over the socket, packets from every source
+    # port still arrive
+    for i in range(4):
+        samples = list(sendto_get_data(q, s, 'collectd-squares.pkts'))
+        check_samples(samples, lambda i: i ** 2, 10, 'test.squares.gauge')
+
+
+def host_packets(host, datafile):
+    """The packets of datafile sent by another host"""
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+    writer = bucky.collectd.CollectDWriter(mtu=65507)
+    for pkt in pkts(datafile):
+        for sample in parser.parse(pkt):
+            header = dict(sample.header, host=host)
+            writer.add(header, [(sample.value_type, sample.value)])
+        writer.flush()
+    return writer.take()
+
+
+def test_plan_migrations():
+    plan = bucky.collectd.CollectDServerMP.plan_migrations
+    t.eq(plan([10, 10], [[(10, "a")], [(10, "b")]], 1.5), [])
+    t.eq(plan([0, 0], [[], []], 1.5), [])
+    # The biggest source that fits goes to the idle worker
+    t.eq(plan([30, 0], [[(10, "a"), (20, "b")], []], 1.2), [("b", 0, 1)])
+    # A single hot source stays where it is
+    t.eq(plan([30, 0], [[(30, "a")], []], 1.2), [])
+    t.eq(plan([40, 0, 0], [[(10, "a"), (10, "b"), (20, "c")], [], []], 1.2),
+         [("c", 0, 1), ("b", 0, 2)])
+
+
+def test_handover_samples():
+    src = bucky.collectd.CollectDHandler(cfg)
+    dst = bucky.collectd.CollectDHandler(cfg)
+    src.prev_samples = {("a", "x"): (1, 10), ("b", "x"): (2, 10)}
+    dst.prev_samples = {("a", "x"): (0, 5), ("c", "x"): (3, 10)}
+    dst.add_samples(src.pop_samples(set(["a"])))
+    t.eq(src.prev_samples, {("b", "x"): (2, 10)})
+    t.eq(dst.prev_samples, {("a", "x"): (1, 10), ("c", "x"): (3, 10)})
+    # Older samples don't replace newer ones
+    dst.add_samples([(("c", "x"), (4, 9))])
+    t.eq(dst.prev_samples[("c", "x")], (3, 10))
+
+
+def derive_packets(hosts):
+    """A derive sample of each of hosts, all at the same time"""
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+    sample = [s for s in parser.parse(next(pkts('collectd-squares.pkts'))) if s["type"] == "derive"][0]
+    writer = bucky.collectd.CollectDWriter(mtu=65507)
+    for host in hosts:
+        writer.add(dict(sample.header, host=host), [(sample.value_type, sample.value)])
+    writer.flush()
+    return writer.take()
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25846)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_balance_threshold", 1.2)
+@t.set_cfg("process_join_timeout", 30)
+def test_handover_large_state():
+    q = multiprocessing.Queue()
+    server = bucky.collectd.CollectDServerMP(q, cfg)
+    server.next_balance = server.next_supervise = float("inf")
+    server.workers = [server.start_worker(i) for i in range(2)]
+    # A moving source with a state much larger than the pipe buffers and
+    # another one that keeps sending to the same worker meanwhile
+    ips = [ip for ip in ("10.0.0.%d" % i for i in range(1, 100)) if server.route(ip) == 0][:2]
+    state = derive_packets("state%d" % i for i in range(20000))
+    load = derive_packets("load%d" % i for i in range(1000))
+    sent = []
+
+    def dispatch():
+        for pkt in state:
+            server.handle(pkt, (ips[0], 25826))
+        server.migrate(ips[0], 0, 1, time.time())
+        while server.migrations and len(sent) < 5000:
+            for pkt in load:
+                server.handle(pkt, (ips[1], 25826))
+                sent.append(pkt)
+
+    dispatcher = threading.Thread(target=dispatch)
+    dispatcher.daemon = True
+    dispatcher.start()
+    dispatcher.join(20)
+    try:
+        t.eq(dispatcher.is_alive(), False)
+        t.eq(server.migrations, {})
+        t.eq(server.late, {})
+        t.eq(server.routes[ips[0]], 1)
+        t.gt(len(sent), 0)
+    finally:
+        if dispatcher.is_alive():
+            # Deadlocked, the pipes of the workers are full
+            for worker, pipe in server.workers:
+                worker.terminate()
+        else:
+            server.pre_shutdown()
+        server.sock.close()
+
+
+def balance_sources():
+    """Two sources hashed to one worker and a third hashed to the other"""
+    workers = {}
+    for i in range(2, 100):
+        ip = "127.0.0.%d" % i
+        index = bucky.helpers.jump_hash(bucky.helpers.stable_hash(ip), 2)
+        workers.setdefault(index, []).append(ip)
+    index = 0 if len(workers[0]) >= 2 else 1
+    ips = workers[index][:2] + workers[1 - index][:1]
+    socks = []
+    for ip in ips:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind((ip, 0))
+        socks.append(sock)
+    data = [host_packets(ip, 'collectd-squares.pkts') for ip in ips]
+    return index, ips, socks, data
+
+
+def run_balance(stopped):
+    """
+    Send the first packet of the sources of the busy worker, stop it for
+    stopped seconds while the second packets of all sources trigger a
+    migration and return the samples received meanwhile and in total.
+    """
+    index, ips, socks, data = balance_sources()
+    during, samples = [], []
+
+    @t.udp_srv(bucky.collectd.getCollectDServer)
+    def run(q, s):
+        for sock, packets in zip(socks[:2], data[:2]):
+            sock.sendto(packets[0], (s.ip, s.port))
+        time.sleep(.6)
+        samples.extend(get_data(q))
+        busy = sorted(child_pids(s.pid))[index]
+        os.kill(busy, signal.SIGSTOP)
+        try:
+            for sock, packets in zip(socks, data):
+                sock.sendto(packets[1], (s.ip, s.port))
+            time.sleep(.1)
+            during.extend(get_data(q))
+            time.sleep(max(0, stopped - .3))
+            # Times out migrations past their deadline
+            socks[2].sendto(b"", (s.ip, s.port))
+            time.sleep(.1)
+        finally:
+            os.kill(busy, signal.SIGCONT)
+        time.sleep(.2)
+        # Picks up the handed over samples
+        socks[2].sendto(b"", (s.ip, s.port))
+        time.sleep(.5)
+        # Ends the interval with the late hand overs
+        socks[2].sendto(b"", (s.ip, s.port))
+        samples.extend(during)
+        samples.extend(get_data(q))
+
+    try:
+        run()
+    finally:
+        for sock in socks:
+            sock.close()
+    return ips, during, samples
+
+
+def check_balance_loads(samples):
+    # Published once per interval for both workers
+    loads = [s[2] for s in samples if s[1].startswith("bucky.CollectDWorker")]
+    loads = [sorted(loads[i:i + 2]) for i in range(0, len(loads), 2)]
+    t.eq(loads[0][0], 0)
+    # Both got packets once a source moved
+    t.gt(max(load[0] for load in loads[1:]), 0)
+
+
+def counters_of(samples, ip):
+    return [s for s in samples if s[0] == ip and s[1] == 'test.squares.counter']
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25843)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_balance_interval", 0.5)
+@t.set_cfg("collectd_balance_threshold", 1.2)
+def test_balance_workers():
+    ips, during, samples = run_balance(.4)
+    # The source on the other worker went on while the busy one was stopped
+    t.gt(len(counters_of(during, ips[2])), 0)
+    t.eq(counters_of(during, ips[0]) + counters_of(during, ips[1]), [])
+    # The moved source kept its counter state
+    for ip in ips[:2]:
+        check_samples([s for s in samples if s[0] == ip], lambda i: (2 * i + 1) / 2., 9,
+                      'test.squares.counter')
+    check_balance_loads(samples)
+    lost = [s[2] for s in samples if s[1] == "bucky.CollectDServerMP.lost_series"]
+    t.eq(sum(lost), 0)
+
+
+@cdtypes(TYPESDB)
+@t.set_cfg("collectd_port", 25844)
+@t.set_cfg("collectd_workers", 2)
+@t.set_cfg("collectd_balance_interval", 0.5)
+@t.set_cfg("collectd_balance_threshold", 1.2)
+@t.set_cfg("process_join_timeout", .2)
+def test_balance_timeout():
+    ips, during, samples = run_balance(.6)
+    # The moved source went on without its state and lost a rate per series
+    counts = sorted(len(counters_of(samples, ip)) for ip in ips[:2])
+    t.eq(counts, [8, 9])
+    lost = [s[2] for s in samples if s[1] == "bucky.CollectDServerMP.lost_series"]
+    t.gt(sum(lost), 0)
+
+
 def test_counter_eq_derive():
     """Test parsing of counters when expecting derives and vice versa"""
 
@@ -257,6 +768,119 @@ def test_counter_eq_derive():
                 t.not_raises(ProtocolError, run_parse(parser.parse), data)
 
 
+def test_parse_malformed():
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+        data = next(pkts('collectd-squares.pkts'))
+        samples = list(parser.parse(data))
+        t.eq(len(samples), 22)
+        t.eq(samples[0]["type"], "gauge")
+        t.eq(samples[0]["value"], 0.0)
+        for bad in (data[:-1], data + b"\x00\x02", data + b"\x00\x02\x00\x00"):
+            t.raises(ProtocolError, lambda: list(parser.parse(bad)))
+
+
+def test_sample_record():
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+        samples = list(parser.parse(next(pkts('collectd-squares.pkts'))))
+    first, last = samples[0], samples[-1]
+    t.eq(first["type"], "gauge")
+    t.eq(first.get("value_name"), "value")
+    t.eq(first.get("missing", "default"), "default")
+    t.isin("plugin", first)
+    t.eq(dict(first)["value"], first.value)
+    # Header fields changed by later parts do not leak into earlier samples
+    t.ne(first["type"], last["type"])
+    t.eq(samples[1].header is first.header, first["type"] == samples[1]["type"])
+    t.hasnot(first, "__setitem__")
+    converter = bucky.collectd.DEFAULT_CONVERTERS["_default"]
+    t.eq(converter(first), ["test", "squares", "gauge"])
+
+
+def test_parse_values():
+    types = "load a:GAUGE:U:U, b:GAUGE:U:U\nmixed a:GAUGE:U:U, b:DERIVE:U:U\n"
+    with t.unlinking(t.temp_file(types)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+    t.eq(parser.types.value_structs["load"].format, "<dd")
+    t.eq(parser.types.value_structs["mixed"], None)
+    data = struct.pack("!HBB", 2, 1, 1) + struct.pack("<dd", 0.5, 1.5)
+    t.eq(list(parser.parse_values("load", memoryview(data))),
+         [("a", 1, 0.5), ("b", 1, 1.5)])
+    data = struct.pack("!HBB", 2, 1, 2) + struct.pack("<d", 0.5) + struct.pack("!q", -3)
+    t.eq(list(parser.parse_values("mixed", memoryview(data))),
+         [("a", 1, 0.5), ("b", 2, -3)])
+    data = struct.pack("!HBB", 2, 1, 0) + struct.pack("<d", 0.5) + struct.pack("!q", -3)
+    t.raises(ProtocolError, lambda: list(parser.parse_values("mixed", memoryview(data))))
+
+
+def test_filter():
+    part_filter = bucky.collectd.CollectDFilter(deny=["cpu", "interface/if_errors", "df/*/inodes-*"])
+    t.eq(part_filter.accepts("cpu", "cpu", "idle"), False)
+    t.eq(part_filter.accepts("interface", "if_errors", "eth0"), False)
+    t.eq(part_filter.accepts("interface", "if_octets", "eth0"), True)
+    t.eq(part_filter.accepts("df", "df_inodes", "inodes-free"), False)
+    t.eq(part_filter.accepts("df", "df_inodes", "free"), True)
+    part_filter = bucky.collectd.CollectDFilter(allow=["test/*"], deny=["*/counter"])
+    t.eq(part_filter.accepts("test", "gauge", ""), True)
+    t.eq(part_filter.accepts("test", "counter", ""), False)
+    t.eq(part_filter.accepts("memory", "memory", "used"), False)
+    t.raises(bucky.errors.ConfigError, bucky.collectd.CollectDFilter, ["a/b/c/d"])
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path], part_filter=part_filter)
+        samples = [s for pkt in pkts('collectd-squares.pkts') for s in parser.parse(pkt)]
+    t.eq(sorted(set(s["type"] for s in samples)), ["absolute", "derive", "gauge"])
+    t.eq(len(samples), 30)
+
+
+@t.set_cfg("collectd_name_cache_size", 2)
+@t.set_cfg("collectd_use_entry_points", False)
+def test_name_cache():
+    calls = []
+
+    def converter(sample):
+        calls.append(sample["type"])
+        if sample.get("type_instance") != "ignored":
+            return ["renamed", sample["type"]]
+
+    def replacement(sample):
+        return ["replaced"]
+    replacement.PRIORITY = 1
+
+    with t.unlinking(t.temp_file(TYPESDB)) as path:
+        parser = bucky.collectd.CollectDParser(types_dbs=[path])
+        samples = list(parser.parse(next(pkts('collectd-squares.pkts'))))
+    sample = samples[0]
+    cfg.collectd_converters = {"test": converter}
+    try:
+        conv = bucky.collectd.CollectDConverter(cfg)
+    finally:
+        cfg.collectd_converters = []
+    t.eq(conv.convert(sample)[1], "renamed.gauge")
+    t.eq(conv.convert(sample)[1], "renamed.gauge")
+    t.eq(len(calls), 1)
+    t.eq(conv.name_cache.hits, 1)
+    # Ignored samples are cached as well
+    header = dict(sample.header, type_instance="ignored")
+    ignored = bucky.collectd.CollectDSample(header, "value", 1, 1.0)
+    t.eq(conv.convert(ignored), None)
+    t.eq(conv.convert(ignored), None)
+    t.eq(len(calls), 2)
+    # Least recently used identifier is evicted
+    other = bucky.collectd.CollectDSample(dict(sample.header, type="other"), "value", 1, 1.0)
+    conv.convert(other)
+    t.eq(len(conv.name_cache), 2)
+    conv.convert(sample)
+    t.eq(len(calls), 4)
+    # Replacing a converter drops the cached names
+    conv._add_converter("test", replacement, source="test")
+    t.eq(len(conv.name_cache), 0)
+    t.eq(conv.convert(sample)[1], "replaced")
+    conv.reload(cfg)
+    t.eq(len(conv.name_cache), 0)
+    t.eq(conv.convert(sample)[1], "test.squares.gauge")
+
+
 def cfg_crypto(sec_level, auth_file):
     sec_level_dec = t.set_cfg('collectd_security_level', sec_level)
     auth_file_dec = authfile(auth_file)
@@ -323,3 +947,10 @@ def test_crypto_auth_reload():
     time.sleep(1)
     t.eq(bool(crypto.parse(signed_pkt)), True)
     t.eq(bool(crypto.parse(enc_pkt)), True)
+    t.eq(list(crypto.user_keys), [b"alice"])
+    # A changed password drops the keys derived from the old one
+    with open(crypto.auth_file, "w") as f:
+        f.write("alice: 87654321\n")
+    time.sleep(1)
+    t.raises(ProtocolError, crypto.parse, signed_pkt)
+    t.raises(ProtocolError, crypto.parse, enc_pkt)
@@ -10,6 +10,7 @@ except ImportError:
 import t
 import bucky.processor
 import bucky.cfg as cfg
+from bucky.frames import SampleFrame
 cfg.debug = True
 
 
@@ -122,3 +123,23 @@ def test_function_error_drop(inq, outq, proc):
     samples = list(send_get_data(data, inq, outq))
     t.eq(proc.is_alive(), True)
     t.eq(len(samples), 0)
+
+
+def move_odd(host, name, val, timestamp):
+    if val % 2:
+        return "moved", name, val, timestamp
+    return host, name, val, timestamp
+
+
+@t.set_cfg("processor", move_odd)
+@processor
+def test_frame(inq, outq, proc):
+    frame = SampleFrame("host", 1000)
+    for i in range(10):
+        frame.add("metric-%d" % i, i)
+    samples = list(send_get_data([frame], inq, outq))
+    t.eq(len(samples), 6)
+    for sample in samples[:5]:
+        t.eq(sample[0], "moved")
+    t.istype(samples[5], SampleFrame)
+    t.eq([s[2] for s in samples[5]], [0, 2, 4, 6, 8])
@@ -13,3 +13,31 @@ def test_file_monitor():
         time.sleep(1)
         t.eq(monitor.modified(), True)
         t.eq(monitor.modified(), False)
+
+
+def test_lru_cache():
+    cache = bucky.helpers.LRUCache(2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    t.eq(cache.get("a"), 1)
+    cache.set("c", 3)
+    t.eq("b" in cache, False)
+    t.eq(cache.get("b"), None)
+    t.eq(cache.get("a"), 1)
+    t.eq(cache.get("c"), 3)
+    t.eq(len(cache), 2)
+    t.eq((cache.hits, cache.misses), (3, 1))
+
+
+def test_jump_hash():
+    keys = [bucky.helpers.stable_hash("10.0.0.%d" % i) for i in range(1000)]
+    t.eq(bucky.helpers.stable_hash(u"10.0.0.0"), keys[0])
+    before = [bucky.helpers.jump_hash(key, 4) for key in keys]
+    after = [bucky.helpers.jump_hash(key, 5) for key in keys]
+    t.eq(set(before), set(range(4)))
+    # Keys only ever move to the added bucket
+    moved = [a for b, a in zip(before, after) if a != b]
+    t.eq(set(moved), set([4]))
+    t.gt(len(moved), 100)
+    t.lt(len(moved), 300)
+    t.eq([bucky.helpers.jump_hash(key, 1) for key in keys[:10]], [0] * 10)
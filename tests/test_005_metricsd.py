@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -
+#
+# Licensed under the Apache License, Version 2.0 (the "License"); you may not
+# use this file except in compliance with the License. You may obtain a copy of
+# the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+# WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+# License for the specific language governing permissions and limitations under
+# the License.
+
+import multiprocessing
+from functools import wraps
+
+import t
+import bucky.metricsd
+from bucky.errors import ConfigError
+
+
+HANDLERS = [("^a\\.", 60, 1), ("^a\\.b", 30, 5), ("^a\\.b\\.c", 20, 3)]
+
+
+def metricsd_srv(func):
+    """Runs func with a MetricsDServer whose handlers are started but not the server"""
+    @wraps(func)
+    def run():
+        server = bucky.metricsd.MetricsDServer(multiprocessing.Queue(), t.cfg)
+        try:
+            func(server)
+        finally:
+            server.close()
+            server.sock.close()
+    return run
+
+
+def shard_index(server, handler):
+    for pattern, shards in server.handlers:
+        if handler in shards:
+            return shards.index(handler)
+
+
+@t.set_cfg("metricsd_port", 23640)
+@t.set_cfg("metricsd_handler_shards", 3)
+@t.set_cfg("metricsd_route_cache_size", 0)
+@metricsd_srv
+def test_shards(server):
+    t.eq([len(shards) for pattern, shards in server.handlers], [3])
+    names = ["gorm.%d" % i for i in range(300)]
+    first = [server._get_handler(name) for name in names]
+    # A name always goes to the same shard
+    t.eq([server._get_handler(name) for name in names], first)
+    t.eq(set(shard_index(server, h) for h in first), set([0, 1, 2]))
+
+
+@t.set_cfg("metricsd_port", 23641)
+@t.set_cfg("metricsd_handler_shards", 2)
+@t.set_cfg("metricsd_route_cache_size", 10)
+@t.set_cfg("metricsd_handlers", HANDLERS)
+@metricsd_srv
+def test_route_cache(server):
+    names = ["a.b.%d" % i for i in range(20)] + ["gorm.%d" % i for i in range(20)]
+    scanned = [server._get_handler(name) for name in names]
+    t.eq(server.route_cache.misses, 40)
+    # Hits for the names still in the cache, a scan for the evicted ones
+    t.eq([server._get_handler(name) for name in names[-10:]], scanned[-10:])
+    t.eq(server.route_cache.hits, 10)
+    t.eq([server._get_handler(name) for name in names], scanned)
+
+
+@t.set_cfg("metricsd_port", 23642)
+@t.set_cfg("metricsd_handlers", HANDLERS)
+@metricsd_srv
+def test_priority(server):
+    # Sorted by priority, the largest first, and the default last
+    t.eq([(pattern and pattern.pattern, shards[0].interval) for pattern, shards in server.handlers],
+         [("^a\\.b", 30), ("^a\\.b\\.c", 20), ("^a\\.", 60), (None, 10.0)])
+    t.eq(server._get_handler("a.b.c.d").interval, 30)
+    t.eq(server._get_handler("a.c").interval, 60)
+    t.eq(server._get_handler("gorm").interval, 10.0)
+
+
+@t.set_cfg("metricsd_port", 23643)
+@t.set_cfg("metricsd_handler_shards", 0)
+def test_invalid_shards():
+    t.raises(ConfigError, bucky.metricsd.MetricsDServer, multiprocessing.Queue(), t.cfg)